@@ -9,40 +9,135 @@ import sys
 sys.path.append("../zincbindpredict")
 from data.hydrophobicity import *
 
-def sequence_site_to_sample(sequence):
+RESIDUES = "ARNDCEQGHILKMFPSTWYV"
+SEQUENCE_WINDOWS = (1, 3, 5)
+
+def sequence_site_to_sample(sequence, indices=None):
     """Takes a sequence site and turns it into a feature sample. The site will
     be a string where the binding residues are upper case and everything else is
-    in lower case."""
+    in lower case - or, if the indices of the binding residues are given, the
+    case of the sequence is ignored and those indices are used instead."""
 
     site = {}
-    residues = [i for i, char in enumerate(sequence) if char.isupper()]
-    for i, residues in enumerate(zip(residues[:-1], residues[1:]), start=1):
-        site[f"gap{i}"] = residues[1] - residues[0] - 1
+    residues = [i for i, char in enumerate(sequence) if char.isupper()] if\
+        indices is None else sorted(int(i) for i in indices)
+    for i, pair in enumerate(zip(residues[:-1], residues[1:]), start=1):
+        site[f"gap{i}"] = pair[1] - pair[0] - 1
         site[f"hydrophobicity{i}"] = average_hydrophobicity(
-            sequence, span=[residues[0], residues[1]]
+            sequence, span=[pair[0], pair[1]]
+        )
+    for window in SEQUENCE_WINDOWS:
+        site[f"hydrophobicity_window_{window}"] = average_hydrophobicity(
+            sequence, window=window, indices=residues
         )
-    site["hydrophobicity_window_1"] = average_hydrophobicity(sequence, window=1)
-    site["hydrophobicity_window_3"] = average_hydrophobicity(sequence, window=3)
-    site["hydrophobicity_window_5"] = average_hydrophobicity(sequence, window=5)
-    site["charged_window_1"] = residue_count(sequence, "DERHK", window=1)
-    site["charged_window_3"] = residue_count(sequence, "DERHK", window=3)
-    site["charged_window_5"] = residue_count(sequence, "DERHK", window=5)
-    for res in "ARNDCEQGHILKMFPSTWYV":
-        site[f"{res}_window_1"] = residue_count(sequence, res, window=1)
-        site[f"{res}_window_3"] = residue_count(sequence, res, window=3)
-        site[f"{res}_window_5"] = residue_count(sequence, res, window=5)
+    for window in SEQUENCE_WINDOWS:
+        site[f"charged_window_{window}"] = residue_count(
+            sequence, "DERHK", window=window, indices=residues
+        )
+    for res in RESIDUES:
+        for window in SEQUENCE_WINDOWS:
+            site[f"{res}_window_{window}"] = residue_count(
+                sequence, res, window=window, indices=residues
+            )
     return site
 
 
-def structure_site_to_sample(residues):
+def sequence_properties(sequence):
+    """Takes a sequence and works out, for every position in it, the totals of
+    the windows either side of that position - hydrophobicity, the number of
+    residues with a hydrophobicity, and the counts of charged residues and of
+    each residue type - along with the size of each window. The windows are
+    sliced exactly as they are in residue_count and average_hydrophobicity.
+
+    This only needs doing once per sequence, after which any number of sites
+    can be turned into samples by summing the rows of their residues."""
+
+    sequence = sequence.upper()
+    length = len(sequence)
+    values = np.array([
+        round(hydrophobicity_scale.get(char, 0) * 100) for char in sequence
+    ], dtype=np.int64)
+    properties = np.column_stack([
+        values, [char in hydrophobicity_scale for char in sequence],
+        [char in "DERHK" for char in sequence]
+    ] + [[char == res for char in sequence] for res in RESIDUES]).astype(
+        np.int64
+    ).reshape(length, len(RESIDUES) + 3)
+    cumulative = np.vstack([
+        np.zeros((1, properties.shape[1]), dtype=np.int64),
+        np.cumsum(properties, axis=0)
+    ])
+    positions = np.arange(length)
+    windows = {}
+    for window in SEQUENCE_WINDOWS:
+        start = positions - window
+        start = np.where(start < 0, np.maximum(start + length, 0), start)
+        end = np.minimum(positions + window + 1, length)
+        size = np.maximum(end - start, 0)
+        sums = np.where(
+            (size > 0)[:, None], cumulative[end] - cumulative[np.minimum(start, end)], 0
+        )
+        odd = size % 2 == 1
+        middle = np.where(odd, start + (size - 1) // 2, 0)
+        sums -= np.where(odd[:, None], properties[middle], 0)
+        windows[window] = {"sums": sums, "sizes": size - odd}
+    return {"cumulative": cumulative, "windows": windows}
+
+
+def sequence_sites_to_samples(sequence, sites, properties=None):
+    """Takes a sequence and an array of sites within it (one row of residue
+    indices per site) and turns them all into a float32 feature matrix with one
+    row per site. The columns are those of sequence_site_to_sample, in the same
+    order. The sequence's properties can be given if they have already been
+    worked out."""
+
+    if properties is None: properties = sequence_properties(sequence)
+    sites = np.sort(np.asarray(sites, dtype=np.int64), axis=1)
+    cumulative = properties["cumulative"]
+    columns = []
+    for start, end in zip(sites.T[:-1], sites.T[1:]):
+        totals = cumulative[end, :2] - cumulative[start + 1, :2]
+        columns.append(end - start - 1)
+        columns.append(_average(totals[:, 0] / 100, totals[:, 1]))
+    hydrophobicities, counts = [], []
+    for window in SEQUENCE_WINDOWS:
+        sums = properties["windows"][window]["sums"][sites].sum(axis=1)
+        sizes = properties["windows"][window]["sizes"][sites].sum(axis=1)
+        hydrophobicities.append(_average(sums[:, 0] / 100, sums[:, 1]))
+        counts.append(_average(sums[:, 2:], sizes[:, None]))
+    columns += hydrophobicities
+    for column in range(len(RESIDUES) + 1):
+        columns += [window_counts[:, column] for window_counts in counts]
+    return np.round(
+        np.column_stack(columns).reshape(len(sites), len(columns)), 3
+    ).astype(np.float32)
+
+
+def _average(totals, sizes):
+    """Divides an array of totals by an array of sizes, giving zero wherever
+    the size is zero."""
+
+    sizes = np.broadcast_to(sizes, totals.shape)
+    return np.divide(
+        totals, sizes, out=np.zeros(totals.shape), where=sizes != 0
+    )
+
+
+def structure_site_to_sample(residues, distances=None):
     """Converts a set of residues into a dict of values ready to be classified
-    by the models."""
+    by the models. The CA and CB distances between each pair of residues are
+    worked out by residue_distances, unless some other function which does
+    the same thing (such as a cached version) is given. If any residue is
+    missing its CA or CB atom (such as a glycine), None is returned."""
 
     sample = {}
     alphas, betas = [], []
+    if distances is None: distances = residue_distances
     for res1, res2 in combinations(residues, 2):
-        alphas.append(res1.atom(name="CA").distance_to(res2.atom(name="CA")))
-        betas.append(res1.atom(name="CB").distance_to(res2.atom(name="CB")))
+        alpha, beta = distances(res1, res2)
+        if alpha is None or beta is None: return None
+        alphas.append(alpha)
+        betas.append(beta)
     sample["ca_mean"] = round(sum(alphas) / len(alphas), 3)
     sample["ca_std"] = round(np.std(alphas), 3)
     sample["ca_min"] = round(min(alphas), 3)
@@ -55,17 +150,103 @@ def structure_site_to_sample(residues):
     return sample
 
 
-def residue_count(sequence, residues, window=1, span=None):
+def structure_arrays(model):
+    """Takes an atomium model and pulls out everything a structure search needs
+    as NumPy arrays - the ID, name, one letter code and CA and CB coordinates
+    of each chain residue (NaN for missing atoms), and the properties of every
+    atom - so that the model can be saved and searched without atomium."""
+
+    residues = [res for chain in sorted(model.chains(), key=lambda c: c.id)
+        for res in chain.residues()]
+    locations = {name: np.array([
+        res.atom(name=name).location if res.atom(name=name) else [np.nan] * 3
+        for res in residues
+    ], dtype=float).reshape(-1, 3) for name in ("CA", "CB")}
+    return {
+        "residues": {
+            "ids": np.array([res.id for res in residues], dtype=str),
+            "names": np.array([res.name for res in residues], dtype=str),
+            "codes": np.array([res.code for res in residues], dtype=str),
+            "ca": locations["CA"], "cb": locations["CB"]
+        }, "atoms": atom_properties(model)
+    }
+
+
+def residue_table(structure, codes=None):
+    """Takes the arrays of a structure and picks out the residues with the
+    given one letter codes (or all of them), so that sites made of those
+    residues can be converted to samples all at once. The distances between
+    every pair of them are worked out here, once."""
+
+    residues = structure["residues"]
+    keep = np.isin(residues["codes"], list(codes)) if codes is not None else\
+        np.ones(len(residues["codes"]), dtype=bool)
+    table = {key: values[keep] for key, values in residues.items()}
+    table["atoms"] = structure["atoms"]
+    for name in ("ca", "cb"):
+        squares = sum((
+            table[name][:, None, axis] - table[name][None, :, axis]
+        ) ** 2 for axis in range(3))
+        table[f"{name}_distances"] = np.sqrt(squares)
+    return table
+
+
+def structure_sites_to_samples(sites, table):
+    """Takes an (n, k) array of sites, as indices of residues in a residue
+    table, and converts them to an array of samples with the same columns as
+    structure_site_to_sample. A boolean array saying which sites could be
+    converted is also returned - sites with a residue missing its CA or CB
+    atom can't be, and their rows are NaN."""
+
+    if not len(sites): return np.zeros((0, 9)), np.zeros(0, dtype=bool)
+    sites = np.asarray(sites, dtype=int)
+    samples = np.full((len(sites), 9), np.nan)
+    pairs = np.array(list(combinations(range(sites.shape[1]), 2))).reshape(-1, 2)
+    for offset, name in ((0, "ca"), (4, "cb")):
+        distances = table[f"{name}_distances"][
+            sites[:, pairs[:, 0]], sites[:, pairs[:, 1]]
+        ]
+        samples[:, offset] = distances.sum(axis=1) / distances.shape[1]
+        samples[:, offset + 1] = np.std(distances, axis=1)
+        samples[:, offset + 2] = distances.min(axis=1)
+        samples[:, offset + 3] = distances.max(axis=1)
+    valid = ~np.isnan(samples[:, :8]).any(axis=1)
+    samples[~valid] = np.nan
+
+    # Hydrophobic contrast is worked out around the mean of the CB atoms
+    centres = table["cb"][sites[valid]].sum(axis=1) / sites.shape[1]
+    samples[valid, 8] = [round(contrast, 3) for contrast in hydrophobic_contrasts(
+        table["atoms"], centres, radius=4, metal=False
+    )]
+    samples[:, :8] = np.round(samples[:, :8], 3)
+    return samples, valid
+
+
+def residue_distances(res1, res2):
+    """Gets the distance between the CA atoms of two residues, and the distance
+    between their CB atoms. If either residue is missing one of these atoms,
+    that distance is None."""
+
+    distances = []
+    for name in ("CA", "CB"):
+        atom1, atom2 = res1.atom(name=name), res2.atom(name=name)
+        distances.append(atom1.distance_to(atom2) if atom1 and atom2 else None)
+    return tuple(distances)
+
+
+def residue_count(sequence, residues, window=1, span=None, indices=None):
     """Counts the number of residues around the binding residues in a sequence
-    that match a list of residus to match."""
+    that match a list of residus to match. The binding residues are the upper
+    case ones unless their indices are given."""
     
     counts = 0
     total_window = 0
-    for index, char in enumerate(sequence):
-        if char.isupper():
-            sub_sequence = sequence[index - window: index + window + 1]
-            for i, sub_char in enumerate(sub_sequence):
-                    if i != (len(sub_sequence) - 1) / 2:
-                        total_window += 1
-                        if sub_char.upper() in residues.upper(): counts += 1
+    if indices is None:
+        indices = [i for i, char in enumerate(sequence) if char.isupper()]
+    for index in indices:
+        sub_sequence = sequence[index - window: index + window + 1]
+        for i, sub_char in enumerate(sub_sequence):
+            if i != (len(sub_sequence) - 1) / 2:
+                total_window += 1
+                if sub_char.upper() in residues.upper(): counts += 1
     return round(counts / total_window, 3) if total_window else 0
\ No newline at end of file
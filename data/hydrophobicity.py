@@ -1,5 +1,9 @@
+import numpy as np
 from atomium import Model, Atom
 
+HCF_CELL_SIZE = 4
+HCF_BATCH_SIZE = 10000
+
 def hydrophobic_contrast_function(residues):
     """Calculates the hydrophobic contrast function for the centre of some
     residues."""
@@ -51,17 +55,14 @@ def atom_solvation(atom):
     :param Atom atom: an atomium atom object.
     :rtype: ``float``"""
 
-    specials = {
-     "O": {"GLU": ["OE1", "OE2"], "ASP": ["OD1", "OD2"]},
-     "N": {"HIS": ["ND1", "NE2"], "ARG": ["NH1", "NH2"]}
-    }
     if atom.element == "C": return 18
     if atom.element == "S": return -5
-    if atom.element in specials:
+    if atom.element in solvation_specials:
         if atom.charge != 0:
             return -37 if atom.element == "O" else -38
-        if atom.het and atom.het.name in specials[atom.element]:
-            if atom.name in specials[atom.element][atom.het.name]:
+        specials = solvation_specials[atom.element]
+        if atom.het and atom.het.name in specials:
+            if atom.name in specials[atom.het.name]:
                 return -23 if atom.element == "O" else -23.5
         return -9
     return 0
@@ -73,38 +74,136 @@ def atom_partial_charge(atom):
     :rtype: ``float``"""
 
     if atom.charge != 0: return atom.charge
-    if atom.residue is not None and atom.residue.name in partial_charges:
-        if atom.name in partial_charges[atom.residue.name]:
-            return partial_charges[atom.residue.name][atom.name]
+    if atom.het is not None and atom.het.name in partial_charges:
+        if atom.name in partial_charges[atom.het.name]:
+            return partial_charges[atom.het.name][atom.name]
     return 0
 
 
-def average_hydrophobicity(sequence, window=1, span=None):
-    """Takes a sequence, looks at the residues on either side of the upper case
-    binding residues, and works out the average of their hydrophobicities."""
+def atom_properties(model, cell_size=HCF_CELL_SIZE):
+    """Takes an atomium model and puts the properties of its atoms that
+    hydrophobic contrast needs - coordinates, solvation, partial charge, and
+    whether they are metals - into arrays. The atoms are also sorted into a
+    grid of cubic cells, so that those near any point can be found quickly."""
 
-    scale = {
-        "A": 0.17, "R": 0.81, "N": 0.42, "D": 1.23, "C": -0.24, "E": 2.02,
-        "Q": 0.58, "G": 0.01, "H": 0.96, "I": -0.31, "L": -0.56, "K": 0.99,
-        "M": -0.23, "F": -1.13, "P": 0.45, "S": 0.13, "T": 0.14, "W": -1.85,
-        "Y": -0.94, "V": 0.07
+    atoms = list(model.atoms())
+    coordinates = np.array([atom.location for atom in atoms], dtype=float)
+    coordinates = coordinates.reshape(-1, 3)
+    cells = np.floor(coordinates / cell_size).astype(np.int64)
+    origin = cells.min(axis=0) if len(atoms) else np.zeros(3, dtype=np.int64)
+    shape = (cells.max(axis=0) - origin + 1) if len(atoms) else np.ones(3, dtype=np.int64)
+    keys = np.ravel_multi_index((cells - origin).T, shape)
+    order = np.argsort(keys, kind="stable")
+    cell_keys, starts, counts = np.unique(
+        keys[order], return_index=True, return_counts=True
+    )
+    return {
+        "coordinates": coordinates[order],
+        "solvation": np.array([atom_solvation(atoms[i]) for i in order], dtype=float),
+        "partial_charge": np.array([
+            atom_partial_charge(atoms[i]) for i in order
+        ], dtype=float),
+        "metal": np.array([atoms[i].is_metal for i in order], dtype=bool),
+        "cell_size": cell_size, "origin": origin, "shape": shape,
+        "cell_keys": cell_keys, "cell_starts": starts, "cell_counts": counts
     }
+
+
+def hydrophobic_contrasts(properties, centres, radius, pc=False, metal=True):
+    """Works out the hydrophobic contrast within a sphere around each of an
+    array of centres, in the same way as hydrophobic_contrast, from the atom
+    properties of a model. The centres are done in batches so that memory use
+    stays bounded."""
+
+    centres = np.asarray(centres, dtype=float).reshape(-1, 3)
+    contrasts = np.zeros(len(centres))
+    for start in range(0, len(centres), HCF_BATCH_SIZE):
+        batch = centres[start:start + HCF_BATCH_SIZE]
+        contrasts[start:start + len(batch)] = _batch_contrasts(
+            properties, batch, radius, pc, metal
+        )
+    return contrasts
+
+
+def _batch_contrasts(properties, centres, radius, pc, metal):
+    """Works out the hydrophobic contrast around a batch of centres, by
+    finding every centre-atom pair in nearby cells and summing over them."""
+
+    # Find which cells might have atoms within the radius of each centre
+    if not len(properties["cell_keys"]): return np.zeros(len(centres))
+    reach = int(np.ceil(radius / properties["cell_size"]))
+    offsets = np.array(np.meshgrid(*[np.arange(-reach, reach + 1)] * 3)).T.reshape(-1, 3)
+    cells = np.floor(centres / properties["cell_size"]).astype(np.int64)
+    cells = cells[:, None, :] + offsets[None, :, :] - properties["origin"]
+    inside = ((cells >= 0) & (cells < properties["shape"])).all(axis=2)
+    centre_indices = np.nonzero(inside)[0]
+    keys = np.ravel_multi_index(cells[inside].T, properties["shape"])
+    positions = np.searchsorted(properties["cell_keys"], keys)
+    positions[positions == len(properties["cell_keys"])] = 0
+    found = properties["cell_keys"][positions] == keys
+    centre_indices, positions = centre_indices[found], positions[found]
+
+    # Expand each centre-cell pair into centre-atom pairs
+    counts = properties["cell_counts"][positions]
+    centre_indices = np.repeat(centre_indices, counts)
+    atom_indices = np.repeat(
+        properties["cell_starts"][positions] - np.cumsum(counts) + counts, counts
+    ) + np.arange(counts.sum())
+
+    # Keep the atoms within the sphere and sum over them
+    vectors = properties["coordinates"][atom_indices] - centres[centre_indices]
+    squares = (vectors ** 2).sum(axis=1)
+    keep = (np.sqrt(squares) <= radius) & (properties["metal"][atom_indices] == metal)
+    centre_indices, atom_indices = centre_indices[keep], atom_indices[keep]
+    squares = squares[keep]
+    solvations = (properties["partial_charge"][atom_indices] ** 2
+        if pc else properties["solvation"][atom_indices])
+    size = len(centres)
+    n = np.bincount(centre_indices, minlength=size)
+    sum_ = np.bincount(centre_indices, solvations * squares, minlength=size)
+    r2 = np.bincount(centre_indices, squares, minlength=size)
+    average_solvation = np.bincount(centre_indices, solvations, minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        contrasts = sum_ - n * (average_solvation / n) * (r2 / n)
+    return np.where(n > 0, contrasts, 0)
+
+
+def average_hydrophobicity(sequence, window=1, span=None, indices=None):
+    """Takes a sequence, looks at the residues on either side of the upper case
+    binding residues, and works out the average of their hydrophobicities. The
+    binding residues can also be given as a list of indices."""
+
     scores = []
     if span:
         for char in sequence[span[0] + 1:span[1]]:
-            score = scale.get(char.upper())
+            score = hydrophobicity_scale.get(char.upper())
             if score is not None: scores.append(score)
     else:
-        for index, char in enumerate(sequence):
-            if char.isupper():
-                sub_sequence = sequence[index - window: index + window + 1]
-                for i, sub_char in enumerate(sub_sequence):
-                    if i != (len(sub_sequence) - 1) / 2:
-                        score = scale.get(sub_char.upper())
-                        if score is not None: scores.append(score)
+        if indices is None:
+            indices = [i for i, char in enumerate(sequence) if char.isupper()]
+        for index in indices:
+            sub_sequence = sequence[index - window: index + window + 1]
+            for i, sub_char in enumerate(sub_sequence):
+                if i != (len(sub_sequence) - 1) / 2:
+                    score = hydrophobicity_scale.get(sub_char.upper())
+                    if score is not None: scores.append(score)
     return round(sum(scores) / len(scores), 3) if len(scores) else 0
 
 
+hydrophobicity_scale = {
+ "A": 0.17, "R": 0.81, "N": 0.42, "D": 1.23, "C": -0.24, "E": 2.02,
+ "Q": 0.58, "G": 0.01, "H": 0.96, "I": -0.31, "L": -0.56, "K": 0.99,
+ "M": -0.23, "F": -1.13, "P": 0.45, "S": 0.13, "T": 0.14, "W": -1.85,
+ "Y": -0.94, "V": 0.07
+}
+
+
+solvation_specials = {
+ "O": {"GLU": ["OE1", "OE2"], "ASP": ["OD1", "OD2"]},
+ "N": {"HIS": ["ND1", "NE2"], "ARG": ["NH1", "NH2"]}
+}
+
+
 partial_charges = {
  "ALA": {
   "C": 0.526,
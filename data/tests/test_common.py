@@ -0,0 +1,198 @@
+import random
+import numpy as np
+from itertools import combinations
+from unittest import TestCase
+from atomium.utilities import parse_string
+from data.common import *
+
+SIDE_CHAINS = {
+    "CYS": [("SG", "S")], "HIS": [("CG", "C"), ("ND1", "N"), ("NE2", "N")],
+    "ASP": [("CG", "C"), ("OD1", "O"), ("OD2", "O")],
+    "GLU": [("CG", "C"), ("CD", "C"), ("OE1", "O"), ("OE2", "O")],
+    "LEU": [("CG", "C"), ("CD1", "C")], "GLY": None
+}
+
+def make_structure(length, seed=0):
+    """Makes a compact, made up protein with the given number of residues -
+    every fifth one a glycine, which has no CB atom - and returns its model."""
+
+    rng, lines, location = random.Random(seed), [], np.zeros(3)
+    names = [name for name in SIDE_CHAINS if name != "GLY"]
+    for number in range(1, length + 1):
+        location = np.clip(location + [
+            rng.uniform(-3.8, 3.8) for _ in range(3)
+        ], -10, 10)
+        name = "GLY" if number % 5 == 0 else rng.choice(names)
+        atoms = [("N", "N", -1.2, 0.5, 0), ("CA", "C", 0, 0, 0),
+            ("C", "C", 1.2, 0.4, 0), ("O", "O", 1.5, 1.5, 0.3)]
+        if SIDE_CHAINS[name] is not None:
+            direction = np.array([rng.uniform(-1, 1) for _ in range(3)])
+            direction /= np.linalg.norm(direction)
+            atoms += [(atom, element, *direction * (1.5 + 1.2 * i))
+                for i, (atom, element) in enumerate(
+                    [("CB", "C")] + SIDE_CHAINS[name]
+                )]
+        for atom, element, *offset in atoms:
+            x, y, z = location + offset
+            lines.append("ATOM  {:5d} {:<4} {} A{:4d}    {:8.3f}{:8.3f}{:8.3f}"
+                "  1.00 10.00          {:>2}".format(
+                    len(lines) + 1, f" {atom}", name, number, x, y, z, element
+                ))
+    return parse_string("\n".join(lines + ["TER", "END"]), "test.pdb").model
+
+
+
+class SequenceSitesToSamplesTests(TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0)
+
+
+    def random_sequence(self, length):
+        return "".join(self.random.choice(RESIDUES) for _ in range(length))
+
+
+    def check_parity(self, sequence, sites):
+        # Averages of hydrophobicities are summed from exact hundredths rather
+        # than one float at a time, so an average which lies exactly half way
+        # between two thousandths can be rounded the other way
+        samples = sequence_sites_to_samples(sequence, sites)
+        self.assertEqual(samples.shape[0], len(sites))
+        self.assertEqual(samples.dtype, np.float32)
+        for site, row in zip(sites, samples):
+            sample = sequence_site_to_sample(sequence, site)
+            self.assertEqual(len(row), len(sample))
+            tolerances = np.array([
+                0.0011 if column.startswith("hydrophobicity") else 1e-6
+                for column in sample
+            ])
+            expected = np.array(list(sample.values()), dtype=np.float32)
+            self.assertTrue(
+                (np.abs(row - expected) <= tolerances).all(),
+                f"{sequence} {site}: {row} != {expected}"
+            )
+
+
+    def test_random_sites_match_dict_samples(self):
+        for _ in range(30):
+            sequence = self.random_sequence(self.random.randint(4, 80))
+            size = self.random.randint(2, min(4, len(sequence)))
+            sites = [sorted(self.random.sample(range(len(sequence)), size))
+                for _ in range(20)]
+            self.check_parity(sequence, sites)
+
+
+    def test_sites_at_ends_of_sequence(self):
+        sequence = self.random_sequence(12)
+        self.check_parity(sequence, [[0, 1], [0, 11], [10, 11], [1, 10]])
+        self.check_parity(sequence, [[0, 5, 11], [0, 1, 2], [9, 10, 11]])
+
+
+    def test_short_sequences(self):
+        for length in (2, 3, 4):
+            sequence = self.random_sequence(length)
+            self.check_parity(sequence, [list(range(length))])
+
+
+    def test_case_is_ignored(self):
+        sequence = self.random_sequence(30)
+        sites = [[2, 9, 20], [0, 1, 29]]
+        np.testing.assert_array_equal(
+            sequence_sites_to_samples(sequence.lower(), sites),
+            sequence_sites_to_samples(sequence, sites)
+        )
+
+
+    def test_unsorted_sites_are_sorted(self):
+        sequence = self.random_sequence(30)
+        np.testing.assert_array_equal(
+            sequence_sites_to_samples(sequence, [[20, 2, 9]]),
+            sequence_sites_to_samples(sequence, [[2, 9, 20]])
+        )
+
+
+    def test_column_order(self):
+        sequence = self.random_sequence(40)
+        sample = sequence_site_to_sample(sequence, [3, 10, 30])
+        columns = list(sample.keys())
+        self.assertEqual(columns[:4], [
+            "gap1", "hydrophobicity1", "gap2", "hydrophobicity2"
+        ])
+        self.assertEqual(columns[4:7], [
+            f"hydrophobicity_window_{w}" for w in SEQUENCE_WINDOWS
+        ])
+        self.assertEqual(columns[7:10], [
+            f"charged_window_{w}" for w in SEQUENCE_WINDOWS
+        ])
+        self.assertEqual(columns[10:], [
+            f"{res}_window_{w}" for res in RESIDUES for w in SEQUENCE_WINDOWS
+        ])
+        row = sequence_sites_to_samples(sequence, [[3, 10, 30]])[0]
+        self.assertEqual(row[columns.index("gap1")], 6)
+        self.assertEqual(row[columns.index("gap2")], 19)
+
+
+
+class StructureSitesToSamplesTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model = make_structure(40)
+        cls.residues = list(cls.model.chain("A").residues())
+        cls.table = residue_table(structure_arrays(cls.model))
+
+
+    def check_parity(self, sites):
+        samples, valid = structure_sites_to_samples(np.array(sites), self.table)
+        self.assertEqual(samples.shape, (len(sites), 9))
+        for site, row, is_valid in zip(sites, samples, valid):
+            sample = structure_site_to_sample([self.residues[i] for i in site])
+            self.assertEqual(is_valid, sample is not None)
+            if sample is not None:
+                np.testing.assert_allclose(
+                    row, list(sample.values()), atol=1e-6, err_msg=str(site)
+                )
+
+
+    def test_sites_match_dict_samples(self):
+        rng = random.Random(0)
+        has_cb = [i for i, res in enumerate(self.residues) if res.name != "GLY"]
+        for size in (2, 3, 4):
+            self.check_parity([
+                sorted(rng.sample(has_cb, size)) for _ in range(40)
+            ])
+
+
+    def test_every_pair_and_triple_of_nearby_residues(self):
+        self.check_parity([list(site) for site in combinations(range(12), 2)])
+        self.check_parity([list(site) for site in combinations(range(12), 3)])
+
+
+    def test_column_order(self):
+        sample = structure_site_to_sample(self.residues[:3])
+        self.assertEqual(list(sample), [
+            "ca_mean", "ca_std", "ca_min", "ca_max",
+            "cb_mean", "cb_std", "cb_min", "cb_max", "hcf"
+        ])
+
+
+    def test_glycine_sites_are_invalid(self):
+        glycine = self.residues.index(self.model.residue("A.5"))
+        self.assertEqual(self.residues[glycine].name, "GLY")
+        self.assertIsNone(self.residues[glycine].atom(name="CB"))
+        self.assertTrue(np.isnan(self.table["cb"][glycine]).all())
+        sites = [[0, 1, glycine], [0, 1, 2], [glycine, 5, 6], [5, 6, 7]]
+        samples, valid = structure_sites_to_samples(np.array(sites), self.table)
+        np.testing.assert_array_equal(valid, [False, True, False, True])
+        self.assertTrue(np.isnan(samples[~valid]).all())
+        self.assertFalse(np.isnan(samples[valid]).any())
+        self.assertIsNone(structure_site_to_sample(
+            [self.residues[i] for i in sites[0]]
+        ))
+        self.check_parity(sites)
+
+
+    def test_no_sites(self):
+        samples, valid = structure_sites_to_samples(np.zeros((0, 3)), self.table)
+        self.assertEqual(samples.shape, (0, 9))
+        self.assertEqual(valid.shape, (0,))
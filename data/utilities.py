@@ -139,6 +139,31 @@ def get_all_uniprot_sequences():
     return ["".join(s.splitlines()[1:]).lower() for s in  text.split(">")[1:]]
 
 
+def read_fasta(path):
+    """A generator which reads a FASTA file one line at a time and yields a
+    (header, sequence) tuple for each record in it, so that the whole file
+    never has to be held in memory."""
+
+    header, lines = None, []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if header is not None: yield header, "".join(lines)
+                header, lines = line[1:], []
+            elif line and header is not None:
+                lines.append(line)
+    if header is not None: yield header, "".join(lines)
+
+
+def count_fasta_records(path):
+    """Counts the records in a FASTA file without reading their sequences into
+    memory."""
+
+    with open(path) as f:
+        return sum(1 for line in f if line.startswith(">"))
+
+
 def get_random_sequence_site(sequence, family):
     """Takes a sequence string and gets a random binding site for a given
     family. If there is no matching site, returns None."""
@@ -49,7 +49,22 @@ with tqdm(total=model_count) as pbar:
                     
                     # Evaluate model
                     model.results = evaluate_model(model, X_test, y_test)
+
+                    # Record gap bounds for pruning sequence searches
+                    if category == "sequence":
+                        model.gap_bounds_, model.gap_recall_loss_ = get_gap_bounds(
+                            X_train, y_train, df.columns[:-1]
+                        )
+
+                    # Record distance cutoff for pruning structure searches
+                    if category == "structure":
+                        model.distance_cutoff_ = get_distance_cutoff(
+                            X_train, df.columns[:-1]
+                        )
                     
+                    # Record how long scoring a candidate takes, for estimates
+                    model.candidate_cost_ = get_candidate_cost(model, X_test)
+
                     # Save model
                     model_name = f"{family}_{int(size * 100)}"
                     if sim is not None: model_name += f"_{int(sim * 100)}"
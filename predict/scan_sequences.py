@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+
+"""Searches every sequence in a FASTA file for zinc binding sites, without
+going through the web server. Records are shared out across a pool of
+processes, each of which loads the sequence models once, and the results are
+written one row per record as newline-delimited JSON or as Parquet.
+
+A checkpoint is saved every so many records, so an interrupted scan can be
+resumed by running the same command again (a checkpoint of a different FASTA
+file, families or format is ignored, and the scan starts again):
+
+    python predict/scan_sequences.py uniprot_all.fasta --output=scan.ndjson
+     --processes=8 --families=C4,H3 --format=ndjson --checkpoint-every=1000
+
+Parquet output (--format=parquet) is written as numbered part files in the
+output directory, one per checkpoint, and needs pyarrow to be installed."""
+
+import sys
+sys.path.append(".")
+import os
+import json
+import time
+from itertools import islice
+from threading import BoundedSemaphore
+from multiprocessing import Pool
+from tqdm import tqdm
+from data.utilities import read_fasta, count_fasta_records
+from server.utilities import get_sequence_families, SiteCollector, ModelRegistry
+from server.utilities import CHUNK_SIZE
+from server.sequence_job import search_sequence
+from predict.utilities import parse_scan_args
+
+TASK_CHUNK_SIZE = 8
+MODELS, SETTINGS = ModelRegistry("sequence"), {}
+
+def main():
+    settings = parse_scan_args(sys.argv[1:])
+    if not settings["fasta"]:
+        print("Please provide a FASTA file to scan")
+        sys.exit(1)
+    families = [f.split("_")[0] for f in get_sequence_families()
+        if f.split("_")[0] in (settings["families"] or [f.split("_")[0]])]
+
+    # Resume from any checkpoint of the same scan
+    scan = {
+        "fasta": os.path.abspath(settings["fasta"]), "families": families,
+        "format": settings["format"]
+    }
+    checkpoint = load_checkpoint(settings["output"], scan)
+    total = count_fasta_records(settings["fasta"])
+    writer = open_writer(settings["output"], settings["format"], checkpoint)
+
+    # Feed records to the pool, never letting more than a few per process wait
+    slots = BoundedSemaphore(settings["processes"] * TASK_CHUNK_SIZE * 4)
+    def records():
+        for index, (header, sequence) in enumerate(islice(
+            read_fasta(settings["fasta"]), checkpoint["records"], None
+        ), start=checkpoint["records"]):
+            slots.acquire()
+            yield index, header, sequence
+
+    start, done = time.time(), checkpoint["records"]
+    with Pool(settings["processes"], initializer=load_models, initargs=(
+        families, settings["chunk_size"] or CHUNK_SIZE
+    )) as pool:
+        with tqdm(total=total, initial=done, unit="seq") as pbar:
+            for row in pool.imap(scan_record, records(), TASK_CHUNK_SIZE):
+                slots.release()
+                writer["write"](row)
+                done += 1
+                pbar.update()
+                if done % settings["checkpoint_every"] == 0:
+                    save_checkpoint(
+                        settings["output"], scan, done, writer["flush"]()
+                    )
+    save_checkpoint(settings["output"], scan, done, writer["flush"]())
+    writer["close"]()
+    scanned = done - checkpoint["records"]
+    print(f"Scanned {scanned} sequences in {round(time.time() - start, 1)}s "
+        f"({round(scanned / max(time.time() - start, 1e-9), 1)} sequences/s)")
+
+
+def load_models(families, chunk_size):
+    """Loads the sequence models of the given families into a worker process.
+    Each model is made to predict on a single thread, as the pool already
+    gives every core a process of its own."""
+
+    SETTINGS["families"], SETTINGS["chunk_size"] = families, chunk_size
+    for family in families: MODELS.get(family).n_jobs = 1
+
+
+def scan_record(record):
+    """Searches one FASTA record, in a worker process, and returns a row of
+    results for it. Rejected sites aren't kept, and each site's residues are
+    given as a list of indices rather than as a sequence."""
+
+    index, header, sequence = record
+    job = {"family_stats": []}
+    search_sequence(
+        job, sequence.upper(), SETTINGS["families"], SETTINGS["chunk_size"],
+        models=MODELS, save=False, collector=SiteCollector(rejected_limit=0),
+        format_site=lambda probability, family, site: {
+            "probability": float(probability), "family": family,
+            "residues": [int(i) for i in site]
+        }
+    )
+    return {
+        "index": index, "id": header, "length": len(sequence),
+        "sites": job.get("sites", []), "site_count": job.get("site_count", 0),
+        "rejected_count": job.get("rejected_count", 0)
+    }
+
+
+def load_checkpoint(output, scan):
+    """Loads the checkpoint of a previous scan to the same output, or returns
+    an empty one if there isn't one. The checkpoint is only used if it is of
+    the same scan - the same FASTA file, families and format - and its output
+    is still there."""
+
+    empty = {**scan, "records": 0, "position": 0}
+    try:
+        with open(f"{output}.checkpoint") as f: checkpoint = json.load(f)
+    except FileNotFoundError: return empty
+    if any(checkpoint.get(key) != value for key, value in scan.items()):
+        print("The checkpoint is of a different scan, starting again")
+        return empty
+    if checkpoint["records"] and not os.path.exists(output):
+        print(f"{output} is missing, starting again")
+        return empty
+    return checkpoint
+
+
+def save_checkpoint(output, scan, records, position):
+    """Atomically records which scan is being done, how many records have been
+    written, and where in the output they end."""
+
+    with open(f"{output}.checkpoint.tmp", "w") as f:
+        json.dump({**scan, "records": records, "position": position}, f)
+    os.replace(f"{output}.checkpoint.tmp", f"{output}.checkpoint")
+
+
+def open_writer(output, format, checkpoint):
+    """Opens the output of a scan, discarding anything written after the last
+    checkpoint, and returns a dictionary of functions for writing rows to it,
+    flushing it to disk (which returns the position to checkpoint) and closing
+    it."""
+
+    if format == "parquet": return open_parquet_writer(output, checkpoint)
+    f = open(output, "r+" if checkpoint["records"] else "w")
+    f.truncate(checkpoint["position"])
+    f.seek(checkpoint["position"])
+
+    def flush():
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+    return {
+        "write": lambda row: f.write(json.dumps(row) + "\n"),
+        "flush": flush, "close": f.close
+    }
+
+
+def open_parquet_writer(output, checkpoint):
+    """Opens a directory of Parquet part files as the output of a scan. Rows are
+    buffered in memory and written as a new part file on each flush."""
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([
+        ("index", pa.int64()), ("id", pa.string()), ("length", pa.int64()),
+        ("sites", pa.list_(pa.struct([
+            ("probability", pa.float64()), ("family", pa.string()),
+            ("residues", pa.list_(pa.int64()))
+        ]))), ("site_count", pa.int64()), ("rejected_count", pa.int64())
+    ])
+    os.makedirs(output, exist_ok=True)
+    for name in os.listdir(output):
+        if not name.startswith("part-") or not name.endswith(".parquet"): continue
+        if int(name[len("part-"):-len(".parquet")]) >= checkpoint["position"]:
+            os.remove(os.path.join(output, name))
+    rows, parts = [], [checkpoint["position"]]
+
+    def flush():
+        if rows:
+            pq.write_table(
+                pa.Table.from_pylist(rows, schema=schema),
+                os.path.join(output, f"part-{parts[0]:05}.parquet")
+            )
+            rows.clear()
+            parts[0] += 1
+        return parts[0]
+
+    return {"write": rows.append, "flush": flush, "close": lambda: None}
+
+
+if __name__ == "__main__": main()
@@ -13,8 +13,9 @@ sys.path.append("../zincbindpredict")
 import warnings
 warnings.warn = lambda *args, **kwargs: None
 from data.utilities import fetch_data
-from data.common import sequence_site_to_vector
-from server.utilities import sequence_to_family_inputs
+from data.common import sequence_site_to_sample
+from server.utilities import sequence_to_family_inputs, site_to_sequence
+from predict.utilities import score_sites, family_threshold
 from collections import Counter
 import joblib
 from tqdm import tqdm
@@ -60,21 +61,18 @@ for chain in tqdm(chains):
 	predicted_sites = []
 	for family in FAMILIES:
 		model = models[family]
-		possibles = list(sequence_to_family_inputs(sequence, family))
+		indices = sequence_to_family_inputs(sequence, family)
+		possibles = [site_to_sequence(sequence, site) for site in indices]
 
 		# Convert possible sites to vectors
-		dicts = [sequence_site_to_vector(possible) for possible in possibles]
+		dicts = [sequence_site_to_sample(sequence, site) for site in indices]
 		vectors = [list(d.values()) for d in dicts]
 		if not vectors: continue
-		max_length = max(len(v) for v in vectors)
-		vectors = [v for v in vectors if len(v) == max_length]
 
-		predicted = model.predict(vectors)
-		probabilities = [p[1] for p in model.predict_proba(vectors)]
-		
-		for index, site in enumerate(possibles):
-			if predicted[index] and probabilities[index] > 0.99:
-				predicted_sites.append(site)
+		_, accepted, _ = score_sites(
+			model, vectors, family_threshold(model, "sequence")
+		)
+		predicted_sites += [possibles[index] for index in accepted]
 	
 	for site in sites:
 		if site in predicted_sites:
@@ -24,6 +24,7 @@ import atomium
 from data.utilities import fetch_data
 from data.common import structure_family_site_to_vector
 from server.utilities import model_to_family_inputs
+from predict.utilities import score_sites, family_threshold
 from collections import Counter
 import joblib
 from tqdm import tqdm
@@ -85,12 +86,12 @@ for pdb in tqdm(pdbs):
 			max_length = max(len(v) for v in vectors)
 			vectors = [v for v in vectors if len(v) == max_length]
 
-			predicted = rf_model.predict(vectors)
-			probabilities = [p[1] for p in rf_model.predict_proba(vectors)]
-			
-			for index, site in enumerate(possibles):
-				if predicted[index] and probabilities[index] > 0.99:
-					predicted_sites.append(frozenset([r.id for r in site]))
+			_, accepted, _ = score_sites(
+				rf_model, vectors, family_threshold(rf_model, "structure")
+			)
+			predicted_sites += [
+				frozenset([r.id for r in possibles[index]]) for index in accepted
+			]
 		
 		for site in sites:
 			if site in predicted_sites:
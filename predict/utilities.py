@@ -1,9 +1,14 @@
 import os
+import time
 import numpy as np
 from sklearn.model_selection import GridSearchCV
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import recall_score, precision_score, f1_score, matthews_corrcoef
 
+GAP_COVERAGE = 0.99
+SCORE_THRESHOLDS = {"sequence": 0.99, "structure": 0.95}
+COST_SAMPLE_SIZE = 10000
+
 def parse_data_args(args):
     """Processes the command line arguments and returns the appropriate
     settings."""
@@ -27,6 +32,36 @@ def parse_data_args(args):
     return (categories, families, similarities, sizes)
 
 
+def parse_scan_args(args):
+    """Processes the command line arguments of the sequence scanner and returns
+    the appropriate settings as a dictionary."""
+
+    settings = {
+        "fasta": None, "output": None, "format": "ndjson",
+        "processes": os.cpu_count(), "families": None,
+        "checkpoint_every": 1000, "chunk_size": None
+    }
+    for arg in args:
+        if not arg.startswith("--"):
+            settings["fasta"] = arg
+        if arg.startswith("--output="):
+            settings["output"] = arg[9:]
+        if arg.startswith("--format="):
+            settings["format"] = arg[9:]
+        if arg.startswith("--processes="):
+            settings["processes"] = int(arg[12:])
+        if arg.startswith("--families="):
+            settings["families"] = arg[11:].split(",")
+        if arg.startswith("--checkpoint-every="):
+            settings["checkpoint_every"] = int(arg[19:])
+        if arg.startswith("--chunk-size="):
+            settings["chunk_size"] = int(arg[13:])
+    if not settings["output"] and settings["fasta"]:
+        extension = "ndjson" if settings["format"] == "ndjson" else "parquet"
+        settings["output"] = f"{os.path.splitext(settings['fasta'])[0]}.{extension}"
+    return settings
+
+
 def get_data_subset(df, size):
     """Gets a random subset of a dataframe, keeping positive and negative
     proportions the same."""
@@ -38,6 +73,47 @@ def get_data_subset(df, size):
     return np.concatenate((positives_subset.values, negatives_subset.values))
 
 
+def get_gap_bounds(X, y, columns, coverage=GAP_COVERAGE):
+    """Works out the range of each gap column that the positive samples of a
+    sequence dataset fall within, ignoring the largest gaps so that only the
+    given fraction of positives are covered. The bounds are returned along
+    with the fraction of positives which fall outside of them - the recall
+    that is lost by not searching outside them."""
+
+    gaps = [i for i, column in enumerate(columns) if column.startswith("gap")]
+    positives = X[y == 1][:, gaps].astype(float)
+    if not len(gaps) or not len(positives): return None, 0
+    bounds = [[
+        int(positives[:, i].min()), int(np.ceil(np.quantile(positives[:, i], coverage)))
+    ] for i in range(len(gaps))]
+    inside = np.all([
+        (positives[:, i] >= bounds[i][0]) & (positives[:, i] <= bounds[i][1])
+        for i in range(len(gaps))
+    ], axis=0)
+    return bounds, round(float(1 - inside.mean()), 3)
+
+
+def get_distance_cutoff(X, columns):
+    """Works out the largest CA distance within any site of a structure
+    dataset, positive or negative. Sites spread out further than this are
+    unlike anything the model was trained on, and needn't be searched."""
+
+    return float(np.ceil(X[:, list(columns).index("ca_max")].astype(float).max()))
+
+
+def get_candidate_cost(model, X, rows=COST_SAMPLE_SIZE):
+    """Times how many seconds a model takes to score one candidate site, on a
+    single thread as the workers run it, from a chunk of rows made by
+    repeating the data given."""
+
+    X = np.resize(X.astype(float), (rows, X.shape[1]))
+    n_jobs, model.n_jobs = model.n_jobs, 1
+    start = time.time()
+    model.predict_proba(X)
+    model.n_jobs = n_jobs
+    return (time.time() - start) / rows
+
+
 def train_model(X, y):
     """Trains a random forest model from the training data given, after doing
     cross-validation to get the best hyperparameters."""
@@ -76,4 +152,24 @@ def evaluate_model(model, X, y):
         "precision": round(precision_score(y, y_pred), 3),
         "f1": round(f1_score(y, y_pred), 3),
         "mcc": round(matthews_corrcoef(y, y_pred), 3),
-    }
\ No newline at end of file
+    }
+
+
+def family_threshold(model, category):
+    """Gets the probability a candidate site must be above for a family's
+    model to accept it - the threshold_ the model was given when it was built,
+    if it has one, and otherwise the default for its category."""
+
+    return getattr(model, "threshold_", SCORE_THRESHOLDS[category])
+
+
+def score_sites(model, vectors, threshold):
+    """Scores candidate sites with a model, walking its trees once, and splits
+    them by a probability threshold. The probability of each site is returned,
+    along with arrays of the indices of the sites accepted and rejected. No
+    site is accepted at 0.5 or below, where the model itself would predict
+    that it doesn't bind."""
+
+    probabilities = model.predict_proba(vectors)[:, 1]
+    accepted = probabilities > max(threshold, 0.5)
+    return probabilities, np.flatnonzero(accepted), np.flatnonzero(~accepted)
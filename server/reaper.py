@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+"""This script deletes old jobs, so that the jobs directory doesn't grow
+forever. Jobs older than JOB_EXPIRATION days are deleted along with their
+uploaded files, and then, if everything left takes up more than
+JOB_DISK_LIMIT bytes, the oldest finished jobs are deleted until it doesn't.
+The worker pool runs it every JOB_REAP_INTERVAL seconds, but it can also be
+run by hand (or from cron, if the pool isn't being used):
+
+    python -m server.reaper
+
+Only finished jobs are deleted to save space, and a job's record in the job
+store is deleted before its files, so a job that is being written is never
+deleted unless it has expired. The jobs of a batch are deleted together."""
+
+import os
+import time
+from .store import get_job_store, FINISHED_STATUSES
+from .settings import JOB_EXPIRATION, JOB_DISK_LIMIT, JOB_STORE_LOCATION
+
+def main():
+    deleted, freed = reap()
+    print(f"Deleted {deleted} jobs, freeing {round(freed / 1024 ** 2, 1)} MB")
+
+
+def reap(expiration=JOB_EXPIRATION * 60 * 60 * 24, limit=JOB_DISK_LIMIT,
+         directory=JOB_STORE_LOCATION):
+    """Deletes expired jobs, and then the oldest finished jobs until the rest
+    fit within the limit. Returns how many jobs were deleted, and how many
+    bytes were freed."""
+
+    store = get_job_store()
+    groups = job_groups(store.summary(), job_files(directory))
+    expired = [batch_id for batch_id, group in groups.items()
+        if group["time"] < time.time() - expiration]
+    total = sum(group["size"] for group in groups.values())
+    kept = total - sum(groups[batch_id]["size"] for batch_id in expired)
+    evicted = []
+    for batch_id in sorted(set(groups) - set(expired), key=lambda b: groups[b]["time"]):
+        if kept <= limit: break
+        if groups[batch_id]["finished"]:
+            evicted.append(batch_id)
+            kept -= groups[batch_id]["size"]
+    for batch_id in expired + evicted:
+        store.delete(groups[batch_id]["jobs"])
+        for path in groups[batch_id]["files"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError: pass
+    return sum(len(groups[b]["jobs"]) for b in expired + evicted), total - kept
+
+
+def job_files(directory):
+    """Finds the files in the jobs directory, and its subdirectories, which
+    belong to a job - uploaded files and old JSON job files - and gives the
+    path and size of each, by the ID of the job it belongs to."""
+
+    files = {}
+    for entry in os.scandir(directory) if os.path.isdir(directory) else []:
+        entries = os.scandir(entry.path) if entry.is_dir() else [entry]
+        for entry in entries:
+            job_id = entry.name.split(".")[0]
+            if entry.is_file() and job_id.split("_")[0].isdigit()\
+                and not entry.name.endswith(".log"):
+                files.setdefault(job_id, []).append(
+                    (entry.path, entry.stat().st_size)
+                )
+    return files
+
+
+def job_groups(jobs, files):
+    """Groups jobs and their files by batch - a job on its own is a batch of
+    one - along with when the batch was started, its total size, and whether
+    every job in it has finished. Files uploaded in the last hour whose job
+    isn't in the job store yet are treated as belonging to an unfinished job,
+    as the job may be about to be saved."""
+
+    groups = {}
+    for job_id in set(jobs) | set(files):
+        batch_id = job_id.split("_")[0]
+        if not batch_id.isdigit(): continue
+        group = groups.setdefault(batch_id, {
+            "time": int(batch_id) / 1000, "jobs": [], "files": [], "size": 0,
+            "finished": True
+        })
+        if job_id in jobs:
+            group["jobs"].append(job_id)
+            group["size"] += jobs[job_id]["size"]
+            group["finished"] &= jobs[job_id]["status"] in FINISHED_STATUSES
+        for path, size in files.get(job_id, []):
+            group["files"].append(path)
+            group["size"] += size
+    for group in groups.values():
+        if not group["jobs"] and group["time"] > time.time() - 60 * 60:
+            group["finished"] = False
+    return groups
+
+
+if __name__ == "__main__": main()
@@ -1,10 +1,52 @@
+import os
 import json
+import time
+import hashlib
 from datetime import datetime
-from subprocess import Popen
 import graphene
 import joblib
 from graphene_file_upload.scalars import Upload
+from graphql import GraphQLError
+from django.conf import settings
+from graphql.language.ast import FieldNode, FragmentSpreadNode
 from .utilities import *
+from .sequence_job import search_sequence
+from data.utilities import read_fasta
+
+FIELD_DEPENDENCIES = {"records": ["records_done"]}
+ROW_ARGUMENTS = dict(
+    first=graphene.Int(), after=graphene.String(),
+    min_probability=graphene.Float()
+)
+
+def requested_fields(info):
+    """Gets the names of the job fields asked for in a query, so that only
+    those need to be read from the job store. Sites and locations aren't
+    included, as they are read a page at a time when they are resolved."""
+
+    def names(selections):
+        for selection in selections:
+            if isinstance(selection, FieldNode):
+                yield selection.name.value
+            elif isinstance(selection, FragmentSpreadNode):
+                yield from names(
+                    info.fragments[selection.name.value].selection_set.selections
+                )
+            else: yield from names(selection.selection_set.selections)
+
+    fields = set()
+    for node in info.field_nodes:
+        for name in names(node.selection_set.selections):
+            name = "".join(
+                "_" + char.lower() if char.isupper() else char for char in name
+            )
+            fields.update([name] + FIELD_DEPENDENCIES.get(name, []))
+    return sorted(fields - {
+        "id", "time", "__typename", "sites", "rejected_sites", "locations",
+        "rejected_locations", "rejected_location_count"
+    })
+
+
 
 class ResidueType(graphene.ObjectType):
 
@@ -15,6 +57,7 @@ class ResidueType(graphene.ObjectType):
 
 class SequenceSiteType(graphene.ObjectType):
 
+    cursor = graphene.String()
     probability = graphene.Float()
     family = graphene.String()
     residues = graphene.String()
@@ -23,6 +66,7 @@ class SequenceSiteType(graphene.ObjectType):
 
 class StructureSiteType(graphene.ObjectType):
 
+    cursor = graphene.String()
     probability = graphene.Float()
     family = graphene.String()
     half = graphene.Boolean()
@@ -35,93 +79,356 @@ class StructureSiteType(graphene.ObjectType):
 
 class StructureLocationType(graphene.ObjectType):
 
+    cursor = graphene.String()
     probability = graphene.Float()
     location = graphene.List(graphene.Float)
     half = graphene.Boolean()
 
 
 
+class FamilyStatsType(graphene.ObjectType):
+
+    family = graphene.String()
+    candidates = graphene.Int()
+    skipped = graphene.Int()
+    recall_loss = graphene.Float()
+    enumeration_time = graphene.Float()
+
+
+
 class AbstractJobType:
 
     id = graphene.String()
+    revision = graphene.Int()
     status = graphene.String()
     protein = graphene.String()
     time = graphene.String()
+    family_stats = graphene.List(FamilyStatsType)
+    site_count = graphene.Int()
+    rejected_count = graphene.Int()
+    rejected_histogram = graphene.List(graphene.Int)
+    cache_hit_rate = graphene.Float()
 
     def resolve_time(self, info, **kwargs):
         return datetime.utcfromtimestamp(
-            int(self.id) / 1000
+            int(self.id.split("_")[0]) / 1000
         ).strftime("%Y-%m-%d %H:%M:%S UTC")
+    
+
+    def resolve_family_stats(self, info, **kwargs):
+        return [FamilyStatsType(**stats) for stats in self.family_stats or []]
+    
+
+    def resolve_site_count(self, info, **kwargs):
+        if self.site_count is None:
+            return count_job_rows(self.id, "sites", self.sites)
+        return self.site_count
+    
+
+    def resolve_rejected_count(self, info, **kwargs):
+        if self.rejected_count is None:
+            return count_job_rows(self.id, "rejected_sites", self.rejected_sites)
+        return self.rejected_count
 
 
 
 class SequenceJobType(AbstractJobType, graphene.ObjectType):
     
     protein = graphene.String()
-    sites = graphene.List(SequenceSiteType)
-    rejected_sites = graphene.List(SequenceSiteType)
-    rejected_count = graphene.Int()
+    sites = graphene.List(SequenceSiteType, **ROW_ARGUMENTS)
+    rejected_sites = graphene.List(SequenceSiteType, **ROW_ARGUMENTS)
 
     def resolve_sites(self, info, **kwargs):
-        return [SequenceSiteType(**site) for site in self.sites]
+        return [SequenceSiteType(**site) for site in load_job_rows(
+            self.id, "sites", self.sites, **kwargs
+        )]
 
 
-    def resolve_rejected_count(self, info, **kwargs):
-        return len(self.rejected_sites)
-    
-
     def resolve_rejected_sites(self, info, **kwargs):
-        return [SequenceSiteType(**site) for site in self.rejected_sites]
+        return [SequenceSiteType(**site) for site in load_job_rows(
+            self.id, "rejected_sites", self.rejected_sites, **kwargs
+        )]
 
 
 
 class StructureJobType(AbstractJobType, graphene.ObjectType):
 
-    sites = graphene.List(StructureSiteType)
-    rejected_sites = graphene.List(StructureSiteType)
-    locations = graphene.List(StructureLocationType)
-    rejected_locations = graphene.List(StructureLocationType)
-    rejected_count = graphene.Int()
+    sites = graphene.List(StructureSiteType, **ROW_ARGUMENTS)
+    rejected_sites = graphene.List(StructureSiteType, **ROW_ARGUMENTS)
+    locations = graphene.List(StructureLocationType, **ROW_ARGUMENTS)
+    rejected_locations = graphene.List(StructureLocationType, **ROW_ARGUMENTS)
     rejected_location_count = graphene.Int()
+    structure_cached = graphene.Boolean()
 
     def resolve_sites(self, info, **kwargs):
-        return [StructureSiteType(**site) for site in self.sites]
-    
-
-    def resolve_rejected_count(self, info, **kwargs):
-        return len(self.rejected_sites)
+        return [StructureSiteType(**site) for site in load_job_rows(
+            self.id, "sites", self.sites, **kwargs
+        )]
     
 
     def resolve_rejected_sites(self, info, **kwargs):
-        return [StructureSiteType(**site) for site in self.rejected_sites]
+        return [StructureSiteType(**site) for site in load_job_rows(
+            self.id, "rejected_sites", self.rejected_sites, **kwargs
+        )]
     
 
     def resolve_locations(self, info, **kwargs):
-        return [StructureLocationType(**site) for site in self.locations]
+        return [StructureLocationType(**site) for site in load_job_rows(
+            self.id, "locations", self.locations, **kwargs
+        )]
     
 
     def resolve_rejected_location_count(self, info, **kwargs):
-        return len(self.rejected_locations)
+        return count_job_rows(
+            self.id, "rejected_locations", self.rejected_locations
+        )
     
 
     def resolve_rejected_locations(self, info, **kwargs):
-        return [StructureLocationType(**site) for site in self.rejected_locations]
+        return [StructureLocationType(**site) for site in load_job_rows(
+            self.id, "rejected_locations", self.rejected_locations, **kwargs
+        )]
     
 
 
+class SequencesJobType(graphene.ObjectType):
+
+    id = graphene.String()
+    revision = graphene.Int()
+    status = graphene.String()
+    protein = graphene.String()
+    time = graphene.String()
+    records_done = graphene.Int()
+    records_total = graphene.Int()
+    records = graphene.List(
+        SequenceJobType, first=graphene.Int(), offset=graphene.Int()
+    )
+
+    def resolve_time(self, info, **kwargs):
+        return datetime.utcfromtimestamp(
+            int(self.id) / 1000
+        ).strftime("%Y-%m-%d %H:%M:%S UTC")
+    
+
+    def resolve_records(self, info, **kwargs):
+        offset = kwargs.get("offset") or 0
+        end = self.records_done if kwargs.get("first") is None else\
+            min(self.records_done, offset + kwargs["first"])
+        fields = requested_fields(info)
+        return [SequenceJobType(**load_job(
+            get_record_job_id(self.id, index), fields, track=False
+        )) for index in range(offset, end)]
+
+
+
+class FamilyEstimateType(graphene.ObjectType):
+
+    family = graphene.String()
+    candidates = graphene.Float()
+    time = graphene.Float()
+
+
+
+class SearchEstimateType(graphene.ObjectType):
+
+    candidates = graphene.Float()
+    time = graphene.Float()
+    families = graphene.List(FamilyEstimateType)
+    admission = graphene.String()
+
+    def resolve_families(self, info, **kwargs):
+        return [FamilyEstimateType(**family) for family in self.families]
+
+
+    def resolve_admission(self, info, **kwargs):
+        return admission(self.time)
+
+
+
+class ResultCacheType(graphene.ObjectType):
+
+    entries = graphene.Int()
+    hits = graphene.Int()
+    misses = graphene.Int()
+    hit_rate = graphene.Float()
+
+    def resolve_hit_rate(self, info, **kwargs):
+        return round(self.hits / (self.hits + self.misses), 3)\
+            if self.hits + self.misses else 0
+
+
+
+class SequencePredictionType(graphene.ObjectType):
+
+    job_id = graphene.String()
+    sites = graphene.List(SequenceSiteType)
+    site_count = graphene.Int()
+    rejected_count = graphene.Int()
+    family_stats = graphene.List(FamilyStatsType)
+
+    def resolve_sites(self, info, **kwargs):
+        return [SequenceSiteType(**site) for site in self.sites or []]
+
+
+    def resolve_family_stats(self, info, **kwargs):
+        return [FamilyStatsType(**stats) for stats in self.family_stats or []]
+
+
+
 class Query(graphene.ObjectType):
     
     sequence_job = graphene.Field(SequenceJobType, id=graphene.String(required=True))
+    sequences_job = graphene.Field(SequencesJobType, id=graphene.String(required=True))
     structure_job = graphene.Field(StructureJobType, id=graphene.String(required=True))
+    result_cache = graphene.Field(ResultCacheType)
+    estimate_search = graphene.Field(
+        SearchEstimateType, sequence=graphene.String(), structure=Upload(),
+        families=graphene.List(graphene.String)
+    )
+    predict_sequence = graphene.Field(
+        SequencePredictionType, sequence=graphene.String(required=True),
+        families=graphene.List(graphene.String)
+    )
 
     def resolve_sequence_job(self, info, **kwargs):
-        with open(get_job_location(kwargs["id"])) as f:
-            return SequenceJobType(**json.load(f))
+        job = load_job(kwargs["id"], requested_fields(info), track=False)
+        return SequenceJobType(**job) if job else None
+    
+
+    def resolve_sequences_job(self, info, **kwargs):
+        job = load_job(kwargs["id"], requested_fields(info), track=False)
+        return SequencesJobType(**job) if job else None
     
 
     def resolve_structure_job(self, info, **kwargs):
-        with open(get_job_location(kwargs["id"])) as f:
-            return StructureJobType(**json.load(f))
+        job = load_job(kwargs["id"], requested_fields(info), track=False)
+        return StructureJobType(**job) if job else None
+
+
+    def resolve_result_cache(self, info, **kwargs):
+        return ResultCacheType(**get_result_cache().stats())
+    
+
+    def resolve_estimate_search(self, info, **kwargs):
+        if kwargs.get("sequence"):
+            return SearchEstimateType(**estimate_sequence_search(
+                kwargs["sequence"].strip().upper(), kwargs.get("families"),
+                get_inline_models()
+            ))
+        if not kwargs.get("structure"):
+            raise GraphQLError("Provide a sequence or a structure to estimate")
+        filename = save_uploaded_file(
+            kwargs["structure"], f"estimate_{int(time.time() * 1000)}"
+        )
+        try:
+            structure = get_structure_residues(filename)
+        finally: os.remove(os.path.join("server", "jobs", filename))
+        return SearchEstimateType(**estimate_structure_search(
+            structure, kwargs.get("families"), get_inline_models("structure")
+        ))
+    
+
+    def resolve_predict_sequence(self, info, **kwargs):
+        sequence = kwargs["sequence"].strip().upper()
+        families = kwargs.get("families")
+        estimate = estimate_sequence_search(
+            sequence, families, get_inline_models()
+        )
+        if estimate["candidates"] > settings.INLINE_SEARCH_CANDIDATES:
+            return SequencePredictionType(
+                job_id=start_sequence_search(
+                    info, kwargs["sequence"], families, estimate
+                )
+            )
+        job = initialize_job(sequence)
+        search_sequence(
+            job, sequence, families, models=get_inline_models(), save=False
+        )
+        return SequencePredictionType(**{
+            key: job[key] for key in
+            ("sites", "site_count", "rejected_count", "family_stats")
+        })
+
+
+
+INLINE_MODELS = {}
+
+def get_inline_models(category="sequence"):
+    """Gets the models of a category kept within the web server - used to
+    search small sequences within the request, and to estimate searches from
+    each model's gap bounds and cost. Each model is loaded the first time it
+    is needed, and kept for every request after."""
+
+    if category not in INLINE_MODELS:
+        INLINE_MODELS[category] = ModelRegistry(category, n_jobs=1)
+    return INLINE_MODELS[category]
+
+
+def start_sequence_search(info, sequence, families, estimate=None):
+    """Starts a sequence search job, unless the same search has been run
+    before, and returns the ID of the job which has (or will have) its
+    results. Searches which would take too long are rejected."""
+
+    sequence = sequence.strip()
+    key = result_cache_key("sequence", hashlib.sha256(
+        sequence.upper().encode()
+    ).hexdigest(), families)
+    job_id = find_cached_job(key)
+    if job_id: return job_id
+    estimate = estimate or estimate_sequence_search(
+        sequence.upper(), families, get_inline_models()
+    )
+    admit(estimate)
+    job = initialize_job(sequence)
+    save_job(job)
+    get_result_cache().put(key, job["id"])
+    if is_server():
+        with open("temp.txt", "w") as f:
+            f.write("Starting job")
+    submit_job("sequence", {
+        "sequence": sequence, "families": families, "job_id": job["id"]
+    }, estimate["time"], get_client(info))
+    return job["id"]
+
+
+
+def get_client(info):
+    """Identifies who sent a request by their IP address, as a hash, so that
+    their jobs can be scheduled fairly alongside everyone else's. Behind
+    proxies this is the address the outermost trusted proxy appended to
+    X-Forwarded-For - anything before it was sent by the client itself."""
+
+    meta = getattr(info.context, "META", {})
+    hops = [hop.strip() for hop in meta.get(
+        "HTTP_X_FORWARDED_FOR", ""
+    ).split(",") if hop.strip()]
+    proxies = settings.JOB_TRUSTED_PROXIES
+    if proxies and len(hops) >= proxies:
+        client = hops[-proxies]
+    else:
+        client = meta.get("REMOTE_ADDR", "")
+    return hashlib.sha256(client.encode()).hexdigest()[:16]
+
+
+def admission(seconds):
+    """Decides what to do with a search estimated to take some number of
+    seconds - accept it, accept it but throttle it, or reject it."""
+
+    if seconds > settings.SEARCH_TIME_LIMIT: return "reject"
+    if seconds > settings.SEARCH_THROTTLE_TIME: return "throttle"
+    return "accept"
+
+
+def admit(estimate):
+    """Raises an error if a search is estimated to take too long to accept."""
+
+    if admission(estimate["time"]) == "reject":
+        raise GraphQLError(
+            f"This search has {estimate['candidates']} candidate sites and "
+            f"would take around {round(estimate['time'] / 3600, 1)} hours, "
+            f"more than the limit of {round(settings.SEARCH_TIME_LIMIT / 3600, 1)}"
+            " - try searching fewer families"
+        )
 
 
 
@@ -134,16 +441,32 @@ class SearchSequence(graphene.Mutation):
     job_id = graphene.String()
 
     def mutate(self, info, **kwargs):
-        job = initialize_job(kwargs["sequence"])
+        return SearchSequence(job_id=start_sequence_search(
+            info, kwargs["sequence"], kwargs.get("families")
+        ))
+
+
+
+class SearchSequences(graphene.Mutation):
+
+    class Arguments:
+        fasta = Upload(required=True)
+        families = graphene.List(graphene.String, description="Site families to limit to")
+    
+    job_id = graphene.String()
+
+    def mutate(self, info, **kwargs):
+        job = initialize_batch_job(kwargs["fasta"].name)
+        kwargs["fasta"] = save_uploaded_file(kwargs["fasta"], job["id"])
+        estimate = estimate_sequences_search((
+            sequence.upper() for _, sequence in read_fasta(
+                os.path.join("server", "jobs", kwargs["fasta"])
+            )
+        ), kwargs.get("families"), get_inline_models())
         save_job(job)
         kwargs["job_id"] = job["id"]
-        if is_server():
-            with open("temp.txt", "w") as f:
-                f.write("Starting job")
-            out = Popen(["python3", "server/sequence_job.py", json.dumps(kwargs)])
-        else:
-            Popen(["python", "server/sequence_job.py", json.dumps(kwargs)])
-        return SearchSequence(job_id=job["id"])
+        submit_job("sequences", kwargs, estimate, get_client(info))
+        return SearchSequences(job_id=job["id"])
 
 
 
@@ -161,13 +484,30 @@ class SearchStructure(graphene.Mutation):
     def mutate(self, info, **kwargs):
         job = initialize_job("", locations=True)
         job["protein"] = kwargs["structure"].name
-        kwargs["structure"] = save_structure_file(kwargs["structure"], job["id"])
+        kwargs["structure"] = save_uploaded_file(kwargs["structure"], job["id"])
+        path = os.path.join("server", "jobs", kwargs["structure"])
+        key = result_cache_key("structure", file_hash(path), kwargs.get("families"), **{
+            flag: bool(kwargs.get(flag)) for flag in (
+                "find_half", "use_families_models", "use_location_models"
+            )
+        })
+        job_id = find_cached_job(key)
+        if job_id:
+            os.remove(path)
+            return SearchStructure(job_id=job_id)
+        estimate = estimate_structure_search(
+            get_structure_residues(kwargs["structure"]), kwargs.get("families"),
+            get_inline_models("structure")
+        )
+        try:
+            admit(estimate)
+        except GraphQLError:
+            os.remove(path)
+            raise
         save_job(job)
+        get_result_cache().put(key, job["id"])
         kwargs["job_id"] = job["id"]
-        if is_server():
-            Popen(["python3", "server/structure_job.py", json.dumps(kwargs)])
-        else:
-            Popen(["python", "server/structure_job.py", json.dumps(kwargs)])
+        submit_job("structure", kwargs, estimate["time"], get_client(info))
         return SearchStructure(job_id=job["id"])
         
 
@@ -175,6 +515,7 @@ class SearchStructure(graphene.Mutation):
 class Mutations(graphene.ObjectType):
     search_structure = SearchStructure.Field()
     search_sequence = SearchSequence.Field()
+    search_sequences = SearchSequences.Field()
 
 
 schema = graphene.Schema(query=Query, mutation=Mutations)
\ No newline at end of file
@@ -8,57 +8,34 @@ import joblib
 import traceback
 from itertools import combinations, product
 from collections import Counter
-from utilities import *
-from data.common import sequence_site_to_sample
+from .utilities import *
+from data.common import sequence_properties, sequence_sites_to_samples
 from data.utilities import split_family
+from predict.utilities import score_sites, family_threshold
 
 from random import random
 from time import sleep
 
 def main():
     # Get arguments from JSON
-    arguments = parse_arguments()
+    run(parse_arguments())
+
+
+def run(arguments, models=None):
+    """Runs a sequence job from its JSON arguments. Models are taken from the
+    model registry if given."""
+
     job_id, sequence = arguments["job_id"], arguments["sequence"].upper()
 
     # Open JSON
     job = load_job(job_id)
 
     try:
-        for family in get_sequence_families():
-            family = family.split("_")[0]
-            if family in arguments.get("families", []) or not arguments.get("families"):
-                # Update status
-                save_job(job, status=f"Looking for {family} sites")
-
-                # Find possible sites for this family
-                possibles = list(sequence_to_family_inputs(sequence, family))
-
-                # Convert possible sites to vectors
-                dicts = [sequence_site_to_sample(possible) for possible in possibles]
-                vectors = [list(d.values()) for d in dicts]
-                if not vectors: continue
-                max_length = max(len(v) for v in vectors)
-                vectors = [v for v in vectors if len(v) == max_length]
+        search_sequence(
+            job, sequence, arguments.get("families"),
+            chunk_size=arguments.get("chunk_size", CHUNK_SIZE), models=models
+        )
 
-                # Run vectors through models
-
-                rf_model = joblib.load(f"predict/models/sequence/{family}_100.joblib")
-                predicted = rf_model.predict(vectors)
-                probabilities = [p[1] for p in rf_model.predict_proba(vectors)]
-
-                
-                # Add sites to job object
-                for site, positive, probability in zip(possibles, predicted, probabilities):
-                    l = job["sites"] if positive and probability > 0.99 else job["rejected_sites"]
-                    site = {
-                        "probability": probability, "family": family, "residues": site
-                    }
-                    if positive and probability > 0.99: l.append(site)
-                    l.sort(key=lambda s: -s["probability"])
-                    
-                # Save job
-                save_job(job)
-        
         # Finish job
         save_job(job, status="complete")
 
@@ -67,4 +44,70 @@ def main():
         raise e
 
 
-if __name__ == "__main__": main()
\ No newline at end of file
+def search_sequence(job, sequence, families=None, chunk_size=CHUNK_SIZE,
+                    models=None, save=True, collector=None, format_site=None):
+    """Looks for binding sites of the given families (or all of them) in a
+    sequence, and adds them to a job dictionary. Models are taken from the
+    model registry if given, so that they can be reused by later searches. If
+    save is True, the job is saved as each family is searched.
+
+    By default sites are written to the job as upper-cased sequences, but a
+    different collector and site formatting function can be given."""
+
+    def sequence_site(probability, family, site):
+        return {
+            "probability": probability, "family": family,
+            "residues": site_to_sequence(sequence, site)
+        }
+
+    cache = JobCache()
+    if collector is None: collector = SiteCollector()
+    if format_site is None: format_site = sequence_site
+    if models is None: models = ModelRegistry("sequence")
+    for family in get_sequence_families():
+        family = family.split("_")[0]
+        if family in (families or []) or not families:
+            # Update status
+            if save: save_job(job, status=f"Looking for {family} sites")
+
+            # Load model if there are any possible sites
+            candidates = count_sequence_family_sites(sequence, family)
+            if not candidates: continue
+            rf_model = models.get(family)
+            gap_bounds = getattr(rf_model, "gap_bounds_", None)
+            threshold = family_threshold(rf_model, "sequence")
+
+            # Go through possible sites a chunk at a time
+            searched = 0
+            properties = cache.get(
+                ("properties",), lambda: sequence_properties(sequence)
+            )
+            for sites in sequence_to_family_chunks(
+                sequence, family, chunk_size, gap_bounds=gap_bounds, cache=cache
+            ):
+                # Convert possible sites to vectors
+                searched += len(sites)
+                vectors = sequence_sites_to_samples(sequence, sites, properties)
+
+                # Run vectors through models
+                probabilities, accepted, rejected = score_sites(
+                    rf_model, vectors, threshold
+                )
+
+                # Add sites to collector
+                collector.add(family, sites, probabilities, accepted, rejected)
+
+            # Record how much of the search was skipped
+            job["family_stats"].append({
+                "family": family, "candidates": candidates,
+                "skipped": candidates - searched,
+                "recall_loss": getattr(rf_model, "gap_recall_loss_", 0)
+            })
+
+            # Save job
+            collector.update_job(job, format_site)
+            job["cache_hit_rate"] = cache.hit_rate
+            if save: save_job(job)
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+
+"""This script finds zinc binding sites in every sequence of a FASTA file.
+
+It takes the same JSON arguments as the other job scripts, with a fasta
+argument giving the name of the FASTA file in the jobs directory. If no
+job_id is given, a new batch job is created for the file - so the script can
+also be run by hand on any local FASTA file:
+
+    python -m server.sequences_job '{"fasta": "proteome.fasta"}'"""
+
+import os
+from .utilities import *
+from .sequence_job import search_sequence
+from data.utilities import read_fasta, count_fasta_records
+
+def main():
+    # Get arguments from JSON
+    arguments = parse_arguments()
+    if "job_id" not in arguments:
+        job = initialize_batch_job(os.path.basename(arguments["fasta"]))
+        save_job(job)
+        print("Job ID:", job["id"])
+        arguments = {**arguments, "job_id": job["id"], "path": arguments["fasta"]}
+    run(arguments)
+
+
+def run(arguments, models=None):
+    """Runs a batch job from its JSON arguments. The FASTA file is looked for
+    in the jobs directory, unless a path argument is given. Models are taken
+    from the model registry if given, and shared between the records."""
+
+    path = arguments.get("path", f"server{os.path.sep}jobs{os.path.sep}{arguments['fasta']}")
+    job = load_job(arguments["job_id"])
+
+    try:
+        # Count records
+        job["records_total"] = count_fasta_records(path)
+        save_job(job, status=f"Searched 0 of {job['records_total']} records")
+
+        # Search each record, reusing the same models
+        if models is None: models = ModelRegistry("sequence")
+        for index, (header, sequence) in enumerate(read_fasta(path)):
+            record_job = initialize_job(header)
+            record_job["id"] = get_record_job_id(job["id"], index)
+            search_sequence(
+                record_job, sequence.upper(), arguments.get("families"),
+                chunk_size=arguments.get("chunk_size", CHUNK_SIZE),
+                models=models, save=False
+            )
+            save_job(record_job, status="complete")
+            job["records_done"] = index + 1
+            save_job(job, status=(
+                f"Searched {job['records_done']} of {job['records_total']} records"
+            ))
+
+        # Finish job
+        save_job(job, status="complete")
+
+    except Exception as e:
+        save_job(job, status="error")
+        raise e
+
+
+if __name__ == "__main__": main()
@@ -47,6 +47,33 @@ DATABASES = {"default": {
 }}
 
 JOB_EXPIRATION = 10
+JOB_DISK_LIMIT = 10 * 1024 ** 3
+JOB_REAP_INTERVAL = 60 * 60
+
+JOB_WORKERS = 2
+JOB_QUEUE_ADDRESS = os.path.join(BASE_DIR, "server", "jobs", "queue.sock")
+JOB_EVENTS_ADDRESS = os.path.join(BASE_DIR, "server", "jobs", "events.sock")
+
+SEARCH_THROTTLE_TIME = 30
+SEARCH_TIME_LIMIT = 60 * 60 * 6
+INLINE_SEARCH_CANDIDATES = 20000
+SEARCH_CANDIDATE_COSTS = {"sequence": 5e-6, "structure": 2.4e-5}
+SEARCH_TREE_COST = 7e-8
+JOB_HEAVY_WORKERS = 1
+JOB_PRIORITY_TIMES = (5, SEARCH_THROTTLE_TIME)
+JOB_TRUSTED_PROXIES = 1
+
+JOB_STORE = "sqlite"
+JOB_STORE_LOCATION = os.path.join(BASE_DIR, "server", "jobs")
+
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_EXPIRATION = JOB_EXPIRATION * 60 * 60 * 24
+
+UPLOAD_SIZE_LIMIT = 200 * 1024 ** 2
+FILE_UPLOAD_HANDLERS = [
+    "django.core.files.uploadhandler.MemoryFileUploadHandler",
+    "server.uploads.LimitedUploadHandler"
+]
 
 GRAPHENE = {
  "SCHEMA": "server.schema.schema"
@@ -0,0 +1,616 @@
+"""Storage for jobs. A job is stored as a set of named fields (its status,
+counts, statistics and so on) plus rows of results (sites and locations),
+each with a probability. Saving a job only writes what has changed since it
+was last saved or loaded, and reads can ask for only some of its fields.
+
+There are two backends - an SQLite database (the default) and an append-only
+log per job - chosen with the JOB_STORE setting."""
+
+import os
+import json
+import time
+import copy
+import base64
+import hashlib
+import sqlite3
+import threading
+from .settings import JOB_STORE, JOB_STORE_LOCATION
+from .settings import RESULT_CACHE_SIZE, RESULT_CACHE_EXPIRATION
+
+ROW_FIELDS = ("sites", "rejected_sites", "locations", "rejected_locations")
+FINISHED_STATUSES = ("complete", "error")
+
+class JobStore:
+    """The parts of a job store common to every backend. Subclasses provide
+    write, which makes one atomic change to a job, read, which gets some or
+    all of a job's fields and rows, and read_rows and count_rows, which get a
+    page of one kind of row or count them, revision, which gets a number
+    which goes up every time the job is written, without reading the job, and
+    updated, which gets when the job was last written. A loaded job has its
+    revision as a field.
+
+    Functions can be added to listeners, to be told of every change this
+    process makes to a job - its ID, the fields which changed, and any new
+    sites."""
+
+    def __init__(self, location):
+        self.location = location
+        self.saved, self.listeners = {}, []
+
+
+    def save(self, job):
+        """Saves a job dictionary. If the job was loaded (or last saved) by this
+        process, only the fields which have changed and the rows which have been
+        added or removed since then are written."""
+
+        previous = self.saved.get(job["id"], {"fields": {}, "rows": {}, "seq": 0})
+        values = {key: value for key, value in job.items()
+            if key not in ("id", "revision") and key not in ROW_FIELDS}
+        values["_rows"] = [kind for kind in ROW_FIELDS if kind in job]
+        fields = {key: value for key, value in values.items()
+            if previous["fields"].get(key, KeyError) != value}
+        added, removed, rows, seq = [], [], {}, previous["seq"]
+        for kind in values["_rows"]:
+            old = previous["rows"].get(kind, set())
+            rows[kind] = set()
+            for row in job[kind]:
+                value = json.dumps(row, sort_keys=True)
+                rows[kind].add(value)
+                if value not in old:
+                    added.append((kind, seq, row.get("probability"), value))
+                    seq += 1
+            removed += [(kind, value) for value in old - rows[kind]]
+        if fields or added or removed:
+            self.write(job["id"], fields, added, removed)
+            self.notify(job["id"], fields, added)
+        if job["id"] in self.saved and job.get("status") not in FINISHED_STATUSES:
+            self.saved[job["id"]] = {
+                "fields": copy.deepcopy(values), "rows": rows, "seq": seq
+            }
+        else: self.saved.pop(job["id"], None)
+
+
+    def update(self, job_id, fields):
+        """Writes some of a job's fields without loading it."""
+
+        self.write(job_id, fields, [], [])
+        self.notify(job_id, fields, [])
+
+
+    def notify(self, job_id, fields, added):
+        """Tells the listeners about a change to a job."""
+
+        if not self.listeners: return
+        fields = {key: value for key, value in fields.items() if key != "_rows"}
+        sites = [json.loads(value) for kind, _, _, value in added if kind == "sites"]
+        for listener in self.listeners: listener(job_id, fields, sites)
+
+
+    def load(self, job_id, fields=None, track=False):
+        """Loads a job dictionary, or None if there is no such job. If field
+        names are given, only those are read. If track is True, the job is
+        remembered, so that saving it later only writes what has changed."""
+
+        names = None if fields is None else\
+            [name for name in fields if name not in ROW_FIELDS] + ["_rows"]
+        kinds = [kind for kind in ROW_FIELDS if fields is None or kind in fields]
+        stored = self.read(job_id, names, kinds)
+        if stored is None: return None
+        values, rows, seq = stored
+        present = values.pop("_rows", [])
+        values.pop("_updated", None)
+        job = {"id": job_id, **values}
+        for kind in kinds:
+            if kind in present or fields is not None:
+                job[kind] = [json.loads(value) for value in rows.get(kind, [])]
+        if track and fields is None:
+            values["_rows"] = present
+            self.saved[job_id] = {
+                "fields": copy.deepcopy(values), "seq": seq,
+                "rows": {kind: set(rows.get(kind, [])) for kind in present}
+            }
+        return job
+
+
+    def rows(self, job_id, kind, first=None, after=None, min_probability=None):
+        """Gets one page of a job's rows of some kind, in order of probability,
+        each with a cursor which can be passed back as after to get the rows
+        which follow it."""
+
+        return [{**json.loads(value), "cursor": encode_cursor(probability, seq)}
+            for probability, seq, value in self.read_rows(
+                job_id, kind, first, after and decode_cursor(after), min_probability
+            )]
+
+
+
+class SQLiteJobStore(JobStore):
+    """Stores jobs in an SQLite database, with one table of fields and one of
+    rows. Each save is a single transaction, and the database is in WAL mode
+    so that jobs can be read while they are being written. A job's revision is
+    a field which each transaction increments, and each transaction records
+    its time in the _updated field."""
+
+    def __init__(self, location):
+        JobStore.__init__(self, location)
+        self.connections = {}
+
+
+    def connect(self):
+        """Returns a connection to the database, opening a new one if this
+        process or thread doesn't have one yet."""
+
+        key = (os.getpid(), threading.get_ident())
+        if key not in self.connections:
+            self.connections[key] = open_database(self.location, """
+                CREATE TABLE IF NOT EXISTS fields (
+                    job_id TEXT, name TEXT, value TEXT,
+                    PRIMARY KEY (job_id, name)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS rows (
+                    job_id TEXT, kind TEXT, seq INTEGER, probability REAL,
+                    value TEXT, PRIMARY KEY (job_id, kind, value)
+                );
+                CREATE INDEX IF NOT EXISTS rows_by_probability
+                    ON rows (job_id, kind, probability DESC, seq);
+            """)
+        return self.connections[key]
+
+
+    def write(self, job_id, fields, added, removed):
+        """Upserts fields, adds and removes rows, increments the revision and
+        records the time, in one transaction."""
+
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO fields VALUES (?, ?, ?)",
+                [(job_id, name, json.dumps(value)) for name, value in fields.items()]
+            )
+            connection.executemany(
+                "DELETE FROM rows WHERE job_id = ? AND kind = ? AND value = ?",
+                [(job_id, kind, value) for kind, value in removed]
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)",
+                [(job_id, *row) for row in added]
+            )
+            connection.execute(
+                "INSERT INTO fields VALUES (?, 'revision', '1') "
+                "ON CONFLICT (job_id, name) DO UPDATE SET value = value + 1",
+                (job_id,)
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO fields VALUES (?, '_updated', ?)",
+                (job_id, json.dumps(time.time()))
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+    def read(self, job_id, names, kinds):
+        """Reads the named fields of a job (or all of them) and the rows of the
+        given kinds, in one transaction."""
+
+        connection = self.connect()
+        connection.execute("BEGIN")
+        try:
+            query = "SELECT name, value FROM fields WHERE job_id = ?"
+            if names is not None:
+                query += f" AND name IN ({', '.join('?' * len(names))})"
+            values = connection.execute(query, [job_id, *(names or [])]).fetchall()
+            if not values: return None
+            rows = {kind: [value for value, in connection.execute(
+                "SELECT value FROM rows WHERE job_id = ? AND kind = ? "
+                "ORDER BY probability DESC, seq", (job_id, kind)
+            )] for kind in kinds}
+            seq = connection.execute(
+                "SELECT MAX(seq) FROM rows WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+        finally: connection.execute("COMMIT")
+        return (
+            {name: json.loads(value) for name, value in values},
+            rows, 0 if seq is None else seq + 1
+        )
+
+
+    def revision(self, job_id):
+        """Reads a job's revision, or None if there is no such job."""
+
+        value = self.connect().execute(
+            "SELECT value FROM fields WHERE job_id = ? AND name = 'revision'",
+            (job_id,)
+        ).fetchone()
+        return value and json.loads(value[0])
+
+
+    def updated(self, job_id):
+        """Reads when a job was last written, or None if it isn't known."""
+
+        value = self.connect().execute(
+            "SELECT value FROM fields WHERE job_id = ? AND name = '_updated'",
+            (job_id,)
+        ).fetchone()
+        return value and json.loads(value[0])
+
+
+    def read_rows(self, job_id, kind, first=None, after=None, min_probability=None):
+        """Reads a page of a job's rows of some kind as (probability, seq,
+        value) tuples, using the probability index."""
+
+        query, parameters = "SELECT probability, seq, value FROM rows "\
+            "WHERE job_id = ? AND kind = ?", [job_id, kind]
+        if min_probability is not None:
+            query += " AND probability >= ?"
+            parameters.append(min_probability)
+        if after is not None:
+            query += " AND (probability < ? OR (probability = ? AND seq > ?))"
+            parameters += [after[0], after[0], after[1]]
+        query += " ORDER BY probability DESC, seq"
+        if first is not None:
+            query += " LIMIT ?"
+            parameters.append(max(first, 0))
+        return self.connect().execute(query, parameters).fetchall()
+
+
+    def count_rows(self, job_id, kind, min_probability=None):
+        """Counts a job's rows of some kind without reading them."""
+
+        query, parameters = "SELECT COUNT(*) FROM rows "\
+            "WHERE job_id = ? AND kind = ?", [job_id, kind]
+        if min_probability is not None:
+            query += " AND probability >= ?"
+            parameters.append(min_probability)
+        return self.connect().execute(query, parameters).fetchone()[0]
+
+
+    def summary(self):
+        """Gets the status and the number of bytes stored of every job. The
+        database file is shared out between the jobs by how much they store,
+        so that the sizes add up to what is actually on disk."""
+
+        connection = self.connect()
+        jobs = {job_id: {"status": json.loads(status), "size": 0}
+            for job_id, status in connection.execute(
+                "SELECT job_id, value FROM fields WHERE name = 'status'"
+            )}
+        for table in ("fields", "rows"):
+            for job_id, size in connection.execute(
+                f"SELECT job_id, SUM(LENGTH(value)) FROM {table} GROUP BY job_id"
+            ):
+                jobs.setdefault(job_id, {"status": None, "size": 0})["size"] += size
+        stored = sum(job["size"] for job in jobs.values())
+        if stored:
+            scale = os.path.getsize(self.location) / stored
+            for job in jobs.values(): job["size"] = round(job["size"] * scale)
+        return jobs
+
+
+    def delete(self, job_ids):
+        """Deletes jobs, in one transaction, and then gives the space they
+        took up back. A database made before auto-vacuum was turned on is
+        vacuumed whole the first time, which turns it on."""
+
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for table in ("fields", "rows"):
+                connection.executemany(
+                    f"DELETE FROM {table} WHERE job_id = ?",
+                    [(job_id,) for job_id in job_ids]
+                )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+        # Shrink the file
+        if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            connection.execute("VACUUM")
+        connection.executescript("PRAGMA incremental_vacuum")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+
+class LogJobStore(JobStore):
+    """Stores each job as an append-only log of changes, one JSON line per
+    save. A line is written with a single append, so a reader sees each save
+    whole or not at all - a partly written last line is ignored. Reading a
+    job replays its log. A job's revision is the length of its log."""
+
+    def path(self, job_id):
+        """Gets where a job's log is - in the job's shard directory, unless it
+        was logged before logs were sharded and is directly in the location."""
+
+        path = os.path.join(self.location, job_shard(job_id), f"{job_id}.log")
+        flat = os.path.join(self.location, f"{job_id}.log")
+        return flat if not os.path.exists(path) and os.path.exists(flat) else path
+
+
+    def write(self, job_id, fields, added, removed):
+        """Appends one change to a job's log."""
+
+        os.makedirs(os.path.dirname(self.path(job_id)), exist_ok=True)
+        line = json.dumps({
+            "fields": fields, "added": added, "removed": removed
+        }) + "\n"
+        with open(self.path(job_id), "a") as f: f.write(line)
+
+
+    def replay(self, job_id):
+        """Replays a job's log, and returns its fields, its rows of each kind
+        as (probability, seq) keyed by value, and the next seq to use."""
+
+        try:
+            with open(self.path(job_id)) as f: lines = f.readlines()
+        except FileNotFoundError: return None
+        values, rows, seq, revision = {}, {}, 0, 0
+        for line in lines:
+            if not line.endswith("\n"): break
+            change, revision = json.loads(line), revision + len(line)
+            values.update(change["fields"])
+            for kind, value in change["removed"]:
+                rows.get(kind, {}).pop(value, None)
+            for kind, row_seq, probability, value in change["added"]:
+                rows.setdefault(kind, {})[value] = (probability, row_seq)
+                seq = max(seq, row_seq + 1)
+        if values: values["revision"] = revision
+        return (values, rows, seq) if values else None
+
+
+    def revision(self, job_id):
+        """Gets the length of a job's log, or None if there is no such job. If
+        the last line is still being written, the log is replayed instead."""
+
+        try:
+            with open(self.path(job_id), "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(size - 1, 0))
+                if f.read(1) == b"\n": return size
+        except FileNotFoundError: return None
+        replayed = self.replay(job_id)
+        return replayed and replayed[0]["revision"]
+
+
+    def updated(self, job_id):
+        """Gets when a job's log was last written, or None if there is no such
+        job."""
+
+        try:
+            return os.path.getmtime(self.path(job_id))
+        except FileNotFoundError: return None
+
+
+    def read(self, job_id, names, kinds):
+        """Returns a job's named fields (or all of them) and its rows of the
+        given kinds."""
+
+        replayed = self.replay(job_id)
+        if replayed is None: return None
+        values, rows, seq = replayed
+        return (
+            {name: value for name, value in values.items()
+                if names is None or name in names},
+            {kind: [value for _, _, value in page_rows(rows.get(kind, {}))]
+                for kind in kinds}, seq
+        )
+
+
+    def read_rows(self, job_id, kind, first=None, after=None, min_probability=None):
+        """Returns a page of a job's rows of some kind as (probability, seq,
+        value) tuples."""
+
+        replayed = self.replay(job_id)
+        if replayed is None: return []
+        return page_rows(
+            replayed[1].get(kind, {}), first, after, min_probability
+        )
+
+
+    def count_rows(self, job_id, kind, min_probability=None):
+        """Counts a job's rows of some kind."""
+
+        return len(self.read_rows(job_id, kind, min_probability=min_probability))
+
+
+    def summary(self):
+        """Gets the status and the size of the log of every job."""
+
+        jobs = {}
+        for shard in os.scandir(self.location) if os.path.isdir(self.location) else []:
+            for entry in os.scandir(shard.path) if shard.is_dir() else [shard]:
+                if not entry.name.endswith(".log"): continue
+                job_id = entry.name[:-4]
+                replayed = self.replay(job_id)
+                jobs[job_id] = {
+                    "status": replayed and replayed[0].get("status"),
+                    "size": entry.stat().st_size
+                }
+        return jobs
+
+
+    def delete(self, job_ids):
+        """Deletes the logs of jobs."""
+
+        for job_id in job_ids:
+            try:
+                os.remove(self.path(job_id))
+            except FileNotFoundError: pass
+
+
+
+class ResultCache:
+    """Remembers which job holds the results of a search, keyed by a hash of
+    everything the results depend on, so that the same search needn't be run
+    twice. Entries expire after a number of seconds, the least recently used
+    are evicted once there are too many, and hits and misses are counted. It is
+    kept in an SQLite database of its own, whichever job store is used."""
+
+    def __init__(self, location, size, expiration):
+        self.location, self.size, self.expiration = location, size, expiration
+        self.connections = {}
+
+
+    def connect(self):
+        """Returns a connection to the database, opening a new one if this
+        process or thread doesn't have one yet."""
+
+        key = (os.getpid(), threading.get_ident())
+        if key not in self.connections:
+            self.connections[key] = open_database(self.location, """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, job_id TEXT, created REAL, used REAL
+                );
+                CREATE INDEX IF NOT EXISTS entries_by_use ON entries (used);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY, value INTEGER
+                );
+            """)
+        return self.connections[key]
+
+
+    def get(self, key, valid=None):
+        """Gets the ID of the job holding the results for a key, or None if
+        there isn't one, it has expired, or it fails the valid function given,
+        and counts the hit or miss."""
+
+        connection = self.connect()
+        entry = connection.execute(
+            "SELECT job_id, created FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if entry and (entry[1] < time.time() - self.expiration or
+            (valid and not valid(entry[0]))):
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            entry = None
+        if entry:
+            connection.execute(
+                "UPDATE entries SET used = ? WHERE key = ?", (time.time(), key)
+            )
+        self.count("hits" if entry else "misses")
+        return entry and entry[0]
+
+
+    def put(self, key, job_id):
+        """Records the job holding the results for a key, evicting expired
+        entries and then the least recently used ones if there are too many."""
+
+        connection = self.connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, job_id, now, now)
+            )
+            connection.execute(
+                "DELETE FROM entries WHERE created < ?", (now - self.expiration,)
+            )
+            connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries "
+                "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.size,)
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+    def count(self, name):
+        """Adds one to a counter."""
+
+        self.connect().execute(
+            "INSERT INTO counters VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+
+    def stats(self):
+        """Gets the number of entries, hits and misses."""
+
+        connection = self.connect()
+        counters = dict(connection.execute("SELECT name, value FROM counters"))
+        return {
+            "entries": connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+            "hits": counters.get("hits", 0), "misses": counters.get("misses", 0)
+        }
+
+
+
+def open_database(location, schema):
+    """Opens an SQLite database in WAL mode, creating it and its tables from
+    the schema given if needed. New databases are made with incremental
+    auto-vacuum, so that the space deletions free can be given back."""
+
+    os.makedirs(os.path.dirname(location) or ".", exist_ok=True)
+    connection = sqlite3.connect(location, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(schema)
+    return connection
+
+
+def page_rows(rows, first=None, after=None, min_probability=None):
+    """Takes a dictionary of (probability, seq) tuples keyed by row value, and
+    returns them as a list of (probability, seq, value) tuples in order of
+    probability, starting after the (probability, seq) of some cursor and
+    stopping after a number of rows if these are given."""
+
+    ordered = sorted(
+        ((probability, seq, value) for value, (probability, seq) in rows.items()
+            if min_probability is None or (probability or 0) >= min_probability),
+        key=lambda row: (-(row[0] or 0), row[1])
+    )
+    if after is not None:
+        ordered = [row for row in ordered
+            if (-(row[0] or 0), row[1]) > (-after[0], after[1])]
+    return ordered if first is None else ordered[:max(first, 0)]
+
+
+def job_shard(job_id):
+    """Gets the name of the subdirectory a job's files are kept in - the start
+    of a hash of its ID, or of its batch job's ID if it is one record of a
+    batch - so that no one directory holds too many files."""
+
+    return hashlib.sha256(job_id.split("_")[0].encode()).hexdigest()[:2]
+
+
+def encode_cursor(probability, seq):
+    """Makes an opaque cursor string for a row."""
+
+    return base64.urlsafe_b64encode(json.dumps([probability, seq]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Gets the probability and seq of a row back from its cursor."""
+
+    probability, seq = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return probability, seq
+
+
+
+STORES = {"sqlite": SQLiteJobStore, "log": LogJobStore}
+_store = {}
+
+def get_job_store():
+    """Gets the job store of the backend in the JOB_STORE setting."""
+
+    if JOB_STORE not in _store:
+        location = os.path.join(JOB_STORE_LOCATION, "jobs.sqlite3")\
+            if JOB_STORE == "sqlite" else JOB_STORE_LOCATION
+        _store[JOB_STORE] = STORES[JOB_STORE](location)
+    return _store[JOB_STORE]
+
+
+def get_result_cache():
+    """Gets the result cache, which is kept alongside the job store."""
+
+    if "results" not in _store:
+        _store["results"] = ResultCache(
+            os.path.join(JOB_STORE_LOCATION, "results.sqlite3"),
+            RESULT_CACHE_SIZE, RESULT_CACHE_EXPIRATION
+        )
+    return _store["results"]
@@ -1,65 +1,105 @@
 #! /usr/bin/env python3
 
+"""This script finds zinc binding sites in a structure."""
+
 import sys
 import os
+import time
 import json
 import joblib
-import atomium
 from itertools import combinations, product
 from collections import Counter
-from utilities import *
+from .utilities import *
 from data.common import *
+from predict.utilities import score_sites, family_threshold
+
+def main():
+    # Get arguments from JSON
+    run(parse_arguments())
+
+
+def run(arguments, models=None):
+    """Runs a structure job from its JSON arguments. Models are taken from the
+    model registry if given."""
+
+    job_id, filename = arguments["job_id"], arguments["structure"]
+
+    # Open JSON
+    job = load_job(job_id)
+
+    try:
+        # Get structure, from the cache if it has been seen before
+        structure, job["structure_cached"] = get_structure_for_job(filename)
+        search_structure(job, structure, arguments.get("families"), models=models)
+
+        # Finish job
+        save_job(job, status="complete")
+
+    except Exception as e:
+        save_job(job, status="error")
+        raise e
 
-# Get arguments from JSON
-arguments = parse_arguments()
-job_id, filename = arguments["job_id"], arguments["structure"]
 
-# Open JSON
-job = load_job(job_id)
+def search_structure(job, structure, families=None, models=None, save=True):
+    """Looks for binding sites of the given families (or all of them) in the
+    arrays of a structure, and adds them to a job dictionary. Models are taken
+    from the model registry if given. If save is True, the job is saved as
+    each family is searched."""
 
-try:
-    # Get model
-    model = get_model_for_job(filename)
+    def format_site(probability, family, site):
+        return {
+            "probability": probability, "family": family, "half": False,
+            "residues": [{
+                "name": str(table["names"][i]), "identifier": str(table["ids"][i])
+            } for i in site]
+        }
 
+    collector = SiteCollector()
+    cache = JobCache()
+    if models is None: models = ModelRegistry("structure")
+    codes = set(code.upper() for family in get_structure_families()
+        for code, _ in split_family(family.split("_")[0].lower()))
+    table = residue_table(structure, codes)
     for family in get_structure_families():
         family = family.split("_")[0]
-        # Update status
-        save_job(job, status=f"Looking for {family} sites")
-
-        # Find possible sites for this family
-        possibles = list(model_to_family_inputs(model, family))
-
-        # Convert possible sites to vectors
-        dicts = [structure_site_to_sample(possible) for possible in possibles]
-        remove = []
-        for i, d in enumerate(dicts):
-            if d is None: remove.append(i)
-        possibles = [p for i, p in enumerate(possibles) if i not in remove]
-        dicts = [d for i, d in enumerate(dicts) if i not in remove]
-        vectors = [list(d.values()) for d in dicts]
-        if not vectors: continue
-
-        # Run vectors through models
-        rf_model = joblib.load(f"predict/models/structure/{family}_100.joblib")
-        predicted = rf_model.predict(vectors)
-        probabilities = [p[1] for p in rf_model.predict_proba(vectors)]
-
-        # Add sites to job object
-        for site, positive, probability in zip(possibles, predicted, probabilities):
-            l = job["sites"] if positive and probability > 0.95 else job["rejected_sites"]
-            site = {
-                "probability": probability, "family": family, "half": False,
-                "residues": [{"name": res.name, "identifier": res.id} for res in site]
-            }
-            l.append(site)
-            l.sort(key=lambda s: -s["probability"])
-                
-        # Save job
-        save_job(job)
-    
-
-    save_job(job, status="complete")
-
-except Exception as e:
-    save_job(job, status="error")
-    raise e
\ No newline at end of file
+        if family in (families or []) or not families:
+            # Update status
+            if save: save_job(job, status=f"Looking for {family} sites")
+
+            # Load model if there are any possible sites
+            candidates = count_structure_family_sites(table, family)
+            if not candidates: continue
+            rf_model = models.get(family)
+            cutoff = getattr(rf_model, "distance_cutoff_", STRUCTURE_DISTANCE_CUTOFF)
+
+            # Find possible sites for this family
+            start = time.time()
+            possibles = structure_family_sites(
+                table, family, cutoff=cutoff, cache=cache
+            )
+            job["family_stats"].append({
+                "family": family, "candidates": candidates,
+                "skipped": candidates - len(possibles),
+                "enumeration_time": round(time.time() - start, 3)
+            })
+
+            # Convert possible sites to vectors
+            vectors, valid = structure_sites_to_samples(possibles, table)
+            possibles, vectors = possibles[valid], vectors[valid]
+            if not len(vectors): continue
+
+            # Run vectors through models
+            probabilities, accepted, rejected = score_sites(
+                rf_model, vectors, family_threshold(rf_model, "structure")
+            )
+
+            # Add sites to collector
+            collector.add(family, possibles, probabilities, accepted, rejected)
+
+            # Save job
+            collector.update_job(job, format_site)
+            job["cache_hit_rate"] = cache.hit_rate
+            if save: save_job(job)
+
+
+if __name__ == "__main__": main()
@@ -0,0 +1,174 @@
+import os
+import tempfile
+from unittest import TestCase
+from server.store import *
+
+class JobStoreTests:
+    """Tests which every backend must pass, mixed into a TestCase for each."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = self.make_store(self.directory.name)
+        self.writes = []
+        write = self.store.write
+        def record(job_id, fields, added, removed):
+            self.writes.append((fields, added, removed))
+            write(job_id, fields, added, removed)
+        self.store.write = record
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def make_job(self, probabilities):
+        return {
+            "id": "1600000000000", "status": "Looking for C4 sites",
+            "family_stats": [], "sites": [{
+                "probability": probability, "family": "C4", "residues": [index]
+            } for index, probability in enumerate(probabilities)]
+        }
+
+
+    def test_missing_job(self):
+        self.assertIsNone(self.store.load("1600000000000"))
+        self.assertIsNone(self.store.revision("1600000000000"))
+
+
+    def test_saved_job_loads(self):
+        job = self.make_job([0.9, 0.5])
+        self.store.save(job)
+        loaded = self.store.load(job["id"])
+        self.assertEqual(loaded.pop("revision"), self.store.revision(job["id"]))
+        self.assertEqual(loaded, job)
+
+
+    def test_save_writes_only_changes(self):
+        job = self.make_job([0.9, 0.5])
+        self.store.save(job)
+        job = self.store.load(job["id"], track=True)
+        job["status"] = "Looking for C2H2 sites"
+        job["sites"] = job["sites"][1:] + [
+            {"probability": 0.7, "family": "C2H2", "residues": [5]}
+        ]
+        self.store.save(job)
+        fields, added, removed = self.writes[-1]
+        self.assertEqual(fields, {"status": "Looking for C2H2 sites"})
+        self.assertEqual([row[2] for row in added], [0.7])
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(
+            [site["probability"] for site in self.store.load(job["id"])["sites"]],
+            [0.7, 0.5]
+        )
+
+
+    def test_unchanged_save_writes_nothing(self):
+        job = self.make_job([0.9])
+        self.store.save(job)
+        job = self.store.load(job["id"], track=True)
+        writes = len(self.writes)
+        self.store.save(job)
+        self.assertEqual(len(self.writes), writes)
+
+
+    def test_fields_only_load(self):
+        job = self.make_job([0.9])
+        self.store.save(job)
+        loaded = self.store.load(job["id"], ["status"])
+        self.assertEqual(set(loaded), {"id", "status"})
+        self.assertEqual(loaded["status"], job["status"])
+        loaded = self.store.load(job["id"], ["status", "sites"])
+        self.assertEqual(loaded["sites"], job["sites"])
+
+
+    def test_cursor_paging(self):
+        probabilities = [0.2, 0.9, 0.5, 0.9, 0.7, 0.1, 0.5]
+        job = self.make_job(probabilities)
+        self.store.save(job)
+        pages, after = [], None
+        while True:
+            page = self.store.rows(job["id"], "sites", first=3, after=after)
+            if not page: break
+            self.assertLessEqual(len(page), 3)
+            pages += page
+            after = page[-1]["cursor"]
+        self.assertEqual(
+            [site["probability"] for site in pages],
+            sorted(probabilities, reverse=True)
+        )
+        self.assertEqual(len({site["cursor"] for site in pages}), len(probabilities))
+        self.assertEqual(
+            [site["residues"] for site in pages if site["probability"] == 0.9],
+            [[1], [3]]
+        )
+        self.assertEqual(self.store.count_rows(job["id"], "sites"), 7)
+        self.assertEqual(self.store.count_rows(job["id"], "sites", 0.5), 5)
+        self.assertEqual(len(self.store.rows(
+            job["id"], "sites", min_probability=0.5
+        )), 5)
+
+
+    def test_cursors_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(0.25, 12)), (0.25, 12))
+
+
+    def test_update_bumps_revision(self):
+        job = self.make_job([0.9])
+        self.store.save(job)
+        revision = self.store.revision(job["id"])
+        changes = []
+        self.store.listeners.append(lambda *change: changes.append(change))
+        self.store.update(job["id"], {"status": "error"})
+        self.assertGreater(self.store.revision(job["id"]), revision)
+        self.assertEqual(self.store.load(job["id"], ["status"])["status"], "error")
+        self.assertEqual(self.store.load(job["id"])["sites"], job["sites"])
+        self.assertEqual(changes, [(job["id"], {"status": "error"}, [])])
+
+
+    def test_save_bumps_revision(self):
+        job = self.make_job([0.9])
+        self.store.save(job)
+        revisions = [self.store.revision(job["id"])]
+        job = self.store.load(job["id"], track=True)
+        job["status"] = "complete"
+        self.store.save(job)
+        revisions.append(self.store.revision(job["id"]))
+        self.assertGreater(revisions[1], revisions[0])
+        self.assertEqual(self.store.load(job["id"])["revision"], revisions[1])
+
+
+    def test_delete(self):
+        job = self.make_job([0.9])
+        self.store.save(job)
+        self.assertIn(job["id"], self.store.summary())
+        self.store.delete([job["id"]])
+        self.assertIsNone(self.store.load(job["id"]))
+        self.assertNotIn(job["id"], self.store.summary())
+
+
+
+class SQLiteJobStoreTests(JobStoreTests, TestCase):
+
+    def make_store(self, directory):
+        return SQLiteJobStore(os.path.join(directory, "jobs.sqlite3"))
+
+
+    def tearDown(self):
+        for connection in self.store.connections.values(): connection.close()
+        JobStoreTests.tearDown(self)
+
+
+
+class LogJobStoreTests(JobStoreTests, TestCase):
+
+    def make_store(self, directory):
+        return LogJobStore(directory)
+
+
+    def test_partly_written_line_is_ignored(self):
+        job = self.make_job([0.9])
+        self.store.save(job)
+        revision = self.store.revision(job["id"])
+        with open(self.store.path(job["id"]), "a") as f: f.write('{"fields": {')
+        self.assertEqual(self.store.revision(job["id"]), revision)
+        self.assertEqual(self.store.load(job["id"], ["status"])["status"], job["status"])
@@ -0,0 +1,45 @@
+import random
+from unittest import TestCase
+from server.utilities import *
+
+class CountSequenceFamilySitesTests(TestCase):
+
+    def setUp(self):
+        self.random = random.Random(0)
+
+
+    def random_sequence(self, length):
+        return "".join(self.random.choice("CHDEAGKL") for _ in range(length))
+
+
+    def test_counts_match_enumeration(self):
+        for family in ("C4", "C2H2", "H3", "C3H1", "D1H1"):
+            for _ in range(20):
+                sequence = self.random_sequence(self.random.randint(1, 120))
+                self.assertEqual(
+                    count_sequence_family_sites(sequence, family),
+                    len(list(sequence_family_sites(sequence, family)))
+                )
+
+
+    def test_gap_bounded_counts_match_enumeration(self):
+        for family in ("C4", "C2H2", "H3", "C3H1", "D1H1"):
+            for _ in range(20):
+                sequence = self.random_sequence(self.random.randint(1, 120))
+                gap_bounds = [sorted([
+                    self.random.randint(0, 20), self.random.randint(0, 40)
+                ]) for _ in range(family_size(family) - 1)]
+                self.assertEqual(
+                    count_sequence_family_sites(sequence, family, gap_bounds),
+                    len(list(sequence_family_sites(
+                        sequence, family, gap_bounds
+                    ))), f"{sequence} {family} {gap_bounds}"
+                )
+
+
+    def test_case_is_ignored(self):
+        sequence = self.random_sequence(60)
+        self.assertEqual(
+            count_sequence_family_sites(sequence.upper(), "C2H2", [[0, 5]] * 3),
+            count_sequence_family_sites(sequence.lower(), "C2H2", [[0, 5]] * 3)
+        )
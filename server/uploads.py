@@ -0,0 +1,19 @@
+"""Django upload handlers."""
+
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.core.files.uploadhandler import StopUpload
+
+class LimitedUploadHandler(TemporaryFileUploadHandler):
+    """Streams uploaded files to temporary files on disk, like Django's own
+    handler, but stops the upload as soon as a file passes UPLOAD_SIZE_LIMIT
+    bytes - the rest of the request body is never read. Why it was stopped is
+    left on the request as upload_error, so that the view can reject it."""
+
+    def receive_data_chunk(self, raw_data, start):
+        limit = settings.UPLOAD_SIZE_LIMIT
+        if start + len(raw_data) > limit:
+            self.request.upload_error =\
+                f"{self.file_name} is larger than {limit / 1024 ** 2:g} MB"
+            raise StopUpload(connection_reset=True)
+        return TemporaryFileUploadHandler.receive_data_chunk(self, raw_data, start)
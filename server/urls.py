@@ -1,8 +1,10 @@
 from graphene_django.views import GraphQLView
-from graphene_file_upload.django import FileUploadGraphQLView
 from django.urls import path
+from . import views
 
 urlpatterns = [
- path("graphql/", FileUploadGraphQLView.as_view(graphiql=True)),
- path("", FileUploadGraphQLView.as_view(graphiql=True)),
+ path("graphql/", views.UploadGraphQLView.as_view(graphiql=True)),
+ path("jobs/<str:id>", views.job),
+ path("jobs/<str:id>/events", views.job_events),
+ path("", views.UploadGraphQLView.as_view(graphiql=True)),
 ]
@@ -4,13 +4,36 @@ import sys
 import os
 sys.path.append(".")
 import time
-from itertools import combinations, product
+from itertools import combinations, product, chain, islice, count
+from bisect import bisect_left, bisect_right
+from math import comb, prod
 import requests
 import atomium
 import os
 import json
+import heapq
+import gzip
+import numpy as np
+from scipy.spatial import cKDTree
 from django.http import JsonResponse
+import hashlib
+import joblib
+from subprocess import Popen
+from multiprocessing.connection import Client
 from data.utilities import split_family
+from data.common import structure_arrays
+from atomium.data import CODES
+from .store import get_job_store, get_result_cache
+from .store import page_rows, encode_cursor, decode_cursor, job_shard
+
+CHUNK_SIZE = 10000
+SITE_LIMIT = 1000
+REJECTED_SITE_LIMIT = 100
+HISTOGRAM_BINS = 20
+STRUCTURE_DISTANCE_CUTOFF = 30
+STRUCTURE_CACHE_DIRECTORY = os.path.join("server", "cache", "structures")
+STRUCTURE_CACHE_SIZE = 1024 ** 3
+SEQUENCES_ESTIMATE_SAMPLE = 100
 
 def is_server():
     return "home" in os.listdir("/")
@@ -22,13 +45,34 @@ def initialize_job(protein, locations=False):
     job =  {
         "id": str(int(time.time() * 1000)),
         "status": "initializing","protein": protein,
-        "sites": [], "rejected_sites": [],
+        "sites": [], "rejected_sites": [], "family_stats": [],
+        "site_count": 0, "rejected_count": 0, "rejected_histogram": [],
+        "cache_hit_rate": 0
     }
     if locations:
         job["locations"], job["rejected_locations"] = [], []
     return job
 
 
+def initialize_batch_job(name):
+    """Creates an empty job dictionary for searching every record of a FASTA
+    file, with an ID created from the current time. Each record's results are
+    stored as a job of their own, with an ID made from this job's ID and the
+    record's position in the file."""
+
+    return {
+        "id": str(int(time.time() * 1000)), "status": "initializing",
+        "protein": name, "records_done": 0, "records_total": 0
+    }
+
+
+def get_record_job_id(job_id, index):
+    """Gets the ID of the job holding the results of one record of a batch
+    job."""
+
+    return f"{job_id}_{index}"
+
+
 def get_job_location(id):
     """Gets the location of a job file on disk."""
 
@@ -38,27 +82,233 @@ def get_job_location(id):
 
 
 def save_job(job, status=None):
-    """Saves a job dictionary to file as JSON."""
+    """Saves a job dictionary to the job store. Only what has changed since the
+    job was loaded is written."""
 
     if status: job["status"] = status
-    with open(get_job_location(job["id"]), "w") as f:
-        json.dump(job, f, indent=4)
-
-
-def save_structure_file(uploaded_file, job_id):
-    """Takes an uploaded file and a job ID, and saves the uploaded locally. The
-    new file name will be returned."""
-
+    get_job_store().save(job)
+
+
+def submit_job(name, arguments, estimate=0, client=None):
+    """Sends a job to the worker pool over its local socket, along with an
+    estimate of how many seconds it will take and the client who sent it. If
+    the pool isn't running, a process is started just for the job instead."""
+
+    from django.conf import settings
+    try:
+        with Client(settings.JOB_QUEUE_ADDRESS, family="AF_UNIX") as connection:
+            connection.send_bytes(json.dumps({
+                "job": name, "arguments": arguments, "estimate": estimate,
+                "client": client
+            }).encode())
+    except (FileNotFoundError, ConnectionRefusedError):
+        python = "python3" if is_server() else "python"
+        Popen([python, "-m", f"server.{name}_job", json.dumps(arguments)])
+
+
+def watch_job(job_id):
+    """Connects to the worker pool's event socket and asks it for the changes
+    to a job as they are saved. Each message received on the connection is a
+    JSON object of the fields that changed and any new sites. If the pool
+    isn't running, None is returned."""
+
+    from django.conf import settings
+    try:
+        connection = Client(settings.JOB_EVENTS_ADDRESS, family="AF_UNIX")
+    except (FileNotFoundError, ConnectionRefusedError): return None
+    connection.send_bytes(str(job_id).encode())
+    connection.recv_bytes()
+    return connection
+
+
+def save_uploaded_file(uploaded_file, job_id):
+    """Takes an uploaded file and a job ID, and saves the uploaded locally, in
+    the job's subdirectory of the jobs directory. The new file name (relative
+    to the jobs directory) will be returned.
+
+    The file is written a block at a time, so it is never held in memory
+    whole. Gzipped files are decompressed as they are written, and lose their
+    .gz extension. Files bigger than UPLOAD_SIZE_LIMIT bytes (before or after
+    decompression) are rejected with a ValueError, and nothing is kept."""
+
+    from django.conf import settings
+    limit = settings.UPLOAD_SIZE_LIMIT
+    message = f"{uploaded_file.name} is larger than {limit / 1024 ** 2:g} MB"
+    if uploaded_file.size is not None and uploaded_file.size > limit:
+        raise ValueError(message)
     name = uploaded_file.name
+    compressed = name.lower().endswith(".gz")
+    if compressed: name = name[:-3]
     file_extension = ("." + name.split(".")[-1]) if "." in name else ""
-    file_name = f"{job_id}{file_extension}"
-    file_path = f"server{os.path.sep}jobs{os.path.sep}{file_name}" if \
-        not is_server() else f"server{os.path.sep}jobs{os.path.sep}{file_name}"
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.read())
+    file_name = os.path.join(job_shard(str(job_id)), f"{job_id}{file_extension}")
+    file_path = f"server{os.path.sep}jobs{os.path.sep}{file_name}"
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    uploaded_file.seek(0)
+    source = gzip.GzipFile(fileobj=uploaded_file) if compressed else uploaded_file
+    try:
+        with open(file_path, "wb") as f:
+            for block in iter(lambda: source.read(1024 * 1024), b""):
+                if f.tell() + len(block) > limit: raise ValueError(message)
+                f.write(block)
+    except BaseException:
+        os.remove(file_path)
+        raise
     return file_name
 
 
+class SiteCollector:
+    """Keeps track of the sites that a job has scored. Only the most probable
+    accepted and rejected sites are kept, in heaps of bounded size, along with
+    running counts of each and a histogram of rejected probabilities - so the
+    memory used, and the size of the job, don't grow with the number of sites
+    scored."""
+
+    def __init__(self, site_limit=SITE_LIMIT, rejected_limit=REJECTED_SITE_LIMIT,
+                 bins=HISTOGRAM_BINS):
+        self.sites, self.rejected_sites = [], []
+        self.site_limit, self.rejected_limit = site_limit, rejected_limit
+        self.site_count, self.rejected_count = 0, 0
+        self.histogram = np.zeros(bins, dtype=int)
+        self.order = count()
+    
+
+    def add(self, family, sites, probabilities, accepted, rejected):
+        """Takes a family, some sites, an array of their probabilities and
+        arrays of the indices of the sites accepted and rejected, and adds them
+        to the collector. Only sites which make it into one of the heaps are
+        ever looked at individually, and those are copied out of the chunk so
+        that keeping them doesn't keep the whole chunk alive."""
+
+        probabilities = np.asarray(probabilities, dtype=float)
+        self.site_count += len(accepted)
+        self.rejected_count += len(rejected)
+        self.histogram += np.histogram(
+            probabilities[rejected], bins=len(self.histogram), range=(0, 1)
+        )[0]
+        for heap, limit, indices in (
+            (self.sites, self.site_limit, accepted),
+            (self.rejected_sites, self.rejected_limit, rejected)
+        ):
+            if not limit: continue
+            if len(indices) > limit:
+                indices = indices[np.argpartition(
+                    -probabilities[indices], limit - 1
+                )[:limit]]
+            for index in indices:
+                probability = probabilities[index]
+                if len(heap) == limit and probability <= heap[0][0]: continue
+                item = (probability, next(self.order), family, sites[index].copy())
+                if len(heap) < limit:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heapreplace(heap, item)
+    
+
+    def update_job(self, job, format_site):
+        """Writes the collected sites and counts to a job dictionary. Each kept
+        site is turned into JSON by the function given, which is called with
+        the site's probability, family and the site itself."""
+
+        for key, heap in (("sites", self.sites), ("rejected_sites", self.rejected_sites)):
+            job[key] = [
+                format_site(probability, family, site) for probability, _, family, site
+                in sorted(heap, key=lambda item: (-item[0], item[1]))
+            ]
+        job["site_count"] = self.site_count
+        job["rejected_count"] = self.rejected_count
+        job["rejected_histogram"] = self.histogram.tolist()
+
+
+
+class ModelRegistry:
+    """Loads the models of one category (sequence or structure) as they are
+    first asked for, and keeps them - so a job limited to some families never
+    loads the others. Models are loaded with joblib's memory-mapping, so the
+    pages of a model file are shared by every process using it. How long each
+    model took to load, and how big its trees are in memory, are recorded. If
+    n_jobs is given, each model predicts on that many threads."""
+
+    def __init__(self, category, mmap_mode="r", n_jobs=None):
+        self.category, self.mmap_mode = category, mmap_mode
+        self.n_jobs, self.models, self.stats = n_jobs, {}, {}
+    
+
+    def families(self):
+        """The families which this category has models for."""
+
+        families = get_sequence_families() if self.category == "sequence"\
+            else get_structure_families()
+        return sorted(set(family.split("_")[0] for family in families))
+    
+
+    def get(self, family):
+        """Returns the model of a family, loading it first if needed."""
+
+        if family not in self.models:
+            start = time.time()
+            model = joblib.load(os.path.join(
+                "predict", "models", self.category, f"{family}_100.joblib"
+            ), mmap_mode=self.mmap_mode)
+            if self.n_jobs is not None: model.n_jobs = self.n_jobs
+            self.models[family] = model
+            self.stats[family] = {
+                "load_time": round(time.time() - start, 3),
+                "size": model_size(model)
+            }
+        return self.models[family]
+    
+
+    def load_all(self):
+        """Loads the model of every family, and returns the registry."""
+
+        for family in self.families(): self.get(family)
+        return self
+
+
+
+class JobCache:
+    """Holds the per-residue and per-residue-pair quantities that a job works
+    out - residue positions, window counts, distances and so on - so that each
+    is only worked out once, however many families need it. Lookups are
+    counted so that the job can report how often something was reused."""
+
+    def __init__(self):
+        self.values = {}
+        self.hits, self.misses = 0, 0
+    
+
+    def get(self, key, function):
+        """Returns the value stored under a key, first storing the result of
+        calling the function given if there isn't one yet."""
+
+        if key in self.values:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.values[key] = function()
+        return self.values[key]
+    
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups which found a value already stored."""
+
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 3) if lookups else 0
+
+
+
+def model_size(model):
+    """Works out how many bytes the node and value arrays of a forest's trees
+    take up in memory."""
+
+    return sum(sum(
+        state[key].nbytes for key in ("nodes", "values")
+    ) for state in (
+        estimator.tree_.__getstate__() for estimator in getattr(model, "estimators_", [])
+    ))
+
+
 def parse_arguments():
     """Gets the JSON arguments passed in at the command line."""
 
@@ -68,11 +318,89 @@ def parse_arguments():
     return json.loads(sys.argv[1])
 
 
-def load_job(id):
-    """Loads a job dictionary from JSON file."""
+def load_job(id, fields=None, track=True):
+    """Loads a job dictionary from the job store, or just the named fields of
+    it, or None if there is no such job. A whole job loaded to be worked on is
+    tracked, so that saving it only writes what has changed. Jobs saved as JSON
+    files before there was a job store are still read from their files."""
+
+    job = get_job_store().load(id, fields, track=track)
+    if job is None and os.path.exists(get_job_location(id)):
+        with open(get_job_location(id)) as f: job = json.load(f)
+    return job
+
+
+def job_revision(id):
+    """Gets a job's revision - a number which goes up whenever the job is
+    saved - without loading it, or None if it isn't in the job store."""
+
+    return get_job_store().revision(id)
+
+
+def load_job_rows(id, kind, rows=None, first=None, after=None,
+                  min_probability=None):
+    """Loads one page of a job's sites or locations from the job store, each
+    with a cursor for getting the page after it. If the rows have already been
+    loaded (as they are for old JSON jobs) they are paged through instead."""
 
-    with open(get_job_location(id)) as f:
-        return json.load(f)
+    if rows is None: return get_job_store().rows(
+        id, kind, first, after, min_probability
+    )
+    return [{**json.loads(value), "cursor": encode_cursor(probability, seq)}
+        for probability, seq, value in page_rows({
+            json.dumps(row): (row["probability"], seq)
+            for seq, row in enumerate(rows)
+        }, first, after and decode_cursor(after), min_probability)]
+
+
+def count_job_rows(id, kind, rows=None):
+    """Counts a job's sites or locations of some kind without loading them,
+    unless they have been loaded already."""
+
+    if rows is None: return get_job_store().count_rows(id, kind)
+    return len(rows)
+
+
+def result_cache_key(category, digest, families=None, **flags):
+    """Makes the result cache key of a search from the SHA-256 hash of what is
+    searched (an upper cased sequence, or a structure file's contents), the
+    families and flags the search was given, and the version of the models it
+    will use."""
+
+    return hashlib.sha256(json.dumps([
+        category, digest,
+        sorted(set(families)) if families else None,
+        sorted(flags.items()), model_set_version(category)
+    ]).encode()).hexdigest()
+
+
+def model_set_version(category):
+    """Gets a hash of the names, sizes and modification times of the model
+    files of a category, which changes whenever any model file does."""
+
+    directory = os.path.join("predict", "models", category)
+    return hashlib.sha256(json.dumps(sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(directory) if entry.name.endswith(".joblib")
+    )).encode()).hexdigest()
+
+
+def find_cached_job(key):
+    """Gets the ID of a job which has already run (or is running) the search
+    with the given result cache key, or None. Jobs which failed or no longer
+    exist are ignored, as are unfinished jobs which haven't been written to
+    for longer than any search should take - their worker has been lost."""
+
+    from django.conf import settings
+    def usable(job_id):
+        job = load_job(job_id, ["status"], track=False)
+        if job is None or job["status"] == "error": return False
+        if job["status"] == "complete": return True
+        updated = get_job_store().updated(job_id) or\
+            int(job_id.split("_")[0]) / 1000
+        return updated > time.time() - settings.SEARCH_TIME_LIMIT
+
+    return get_result_cache().get(key, usable)
 
 
 def get_sequence_families():
@@ -84,25 +412,226 @@ def get_sequence_families():
     return sorted(set([model.split("-")[0] for model in models]))
 
 
-def sequence_to_family_inputs(sequence, family):
-    """Takes a sequence and returns a list of potential binding sites for a
-    given family."""
+def sequence_to_family_inputs(sequence, family, gap_bounds=None):
+    """Takes a sequence and returns potential binding sites for a given family,
+    as a NumPy array with one row per site. Each row contains the indices of
+    the site's binding residues, in ascending order."""
+
+    return np.concatenate(list(sequence_to_family_chunks(
+        sequence, family, chunk_size=CHUNK_SIZE, gap_bounds=gap_bounds
+    )) or [np.zeros((0, family_size(family)), dtype=np.int32)])
+
+
+def sequence_to_family_chunks(sequence, family, chunk_size=CHUNK_SIZE,
+                              gap_bounds=None, cache=None):
+    """A generator which yields the potential binding sites for a given family
+    in a sequence as arrays of no more than chunk_size rows, in the same form as
+    sequence_to_family_inputs. The sites are enumerated lazily, so memory use
+    depends on the chunk size and not on the number of sites."""
+
+    sites = sequence_family_sites(
+        sequence, family, gap_bounds=gap_bounds, cache=cache
+    )
+    size = family_size(family)
+    while True:
+        chunk = np.fromiter(chain.from_iterable(
+            islice(sites, chunk_size)
+        ), dtype=np.int32).reshape(-1, size)
+        if not len(chunk): return
+        yield chunk
+
+
+def sequence_family_sites(sequence, family, gap_bounds=None, cache=None):
+    """A generator which yields every combination of residue indices in a
+    sequence that matches a family, as ascending tuples.
+
+    If gap bounds are given - one [minimum, maximum] pair for each gap between
+    consecutive residues - the search only ever looks for the next residue
+    within the allowed gap of the previous one, so combinations that break
+    the bounds are skipped without being generated. The positions of each
+    residue type are taken from the job cache if one is given."""
 
     sequence, family = sequence.lower(), family.lower()
     subfamilies = split_family(family)
-    subfamily_combinations = []
-    for subfamily in subfamilies:
-        subfamily_indices = [i for i, char in enumerate(sequence)
-            if char == subfamily[0]]
-        subfamily_combinations.append(
-            list(combinations(subfamily_indices, subfamily[1]))
+    size = sum(subfamily[1] for subfamily in subfamilies)
+    if cache is None: cache = JobCache()
+    positions = {code: cache.get(("positions", code), lambda: [
+        i for i, char in enumerate(sequence) if char == code
+    ]) for code, _ in subfamilies}
+    if gap_bounds is None: gap_bounds = [[0, len(sequence)]] * (size - 1)
+
+    def extend(site, remaining):
+        if len(site) == size:
+            yield tuple(site)
+            return
+        for code, count in remaining.items():
+            if not count: continue
+            indices = positions[code]
+            start, end = 0, len(indices)
+            if site:
+                lower, upper = gap_bounds[len(site) - 1]
+                start = bisect_left(indices, site[-1] + lower + 1)
+                end = bisect_right(indices, site[-1] + upper + 1)
+            for index in indices[start:end]:
+                yield from extend(site + [index], {**remaining, code: count - 1})
+
+    yield from extend([], dict(subfamilies))
+
+
+def count_sequence_family_sites(sequence, family, gap_bounds=None):
+    """Works out how many combinations of residues in a sequence match a
+    family, without enumerating them. If gap bounds are given, only the
+    combinations that sequence_family_sites would generate with them are
+    counted - the number of partial sites ending at each position is carried
+    from one residue of the site to the next as a running sum."""
+
+    sequence = sequence.lower()
+    subfamilies = split_family(family.lower())
+    if gap_bounds is None:
+        return prod(comb(sequence.count(code), count)
+            for code, count in subfamilies)
+    codes = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    members = [codes == ord(code) for code, _ in subfamilies]
+    layer = {tuple(count for _, count in subfamilies): np.ones(len(codes))}
+    for placed in range(sum(count for _, count in subfamilies)):
+        next_layer = {}
+        for remaining, ends in layer.items():
+            # Count the partial sites each position can extend
+            if placed:
+                lower, upper = gap_bounds[placed - 1]
+                totals = np.concatenate([[0], np.cumsum(ends)])
+                positions = np.arange(len(codes))
+                ends = totals[np.clip(positions - lower, 0, len(codes))] -\
+                    totals[np.clip(positions - upper - 1, 0, len(codes))]
+
+            # Extend them with each residue still needed
+            for i, member in enumerate(members):
+                if not remaining[i]: continue
+                key = remaining[:i] + (remaining[i] - 1,) + remaining[i + 1:]
+                next_layer[key] = next_layer.get(key, 0) + ends * member
+        layer = next_layer
+    return int(round(sum(ends.sum() for ends in layer.values())))
+
+
+def candidate_cost(category, model=None):
+    """Gets how many seconds searching one candidate site takes - the time it
+    takes to enumerate and featurize a candidate of the category, and the time
+    the family's model takes to score it. That is measured when the model is
+    built, and for older models is worked out from how many trees it has."""
+
+    from django.conf import settings
+    cost = settings.SEARCH_CANDIDATE_COSTS[category]
+    if model is None: return cost
+    scoring = getattr(model, "candidate_cost_", None)
+    if scoring is None:
+        scoring = settings.SEARCH_TREE_COST * getattr(model, "n_estimators", 0)
+    return cost + scoring
+
+
+def estimate_search(category, counts, models=None):
+    """Takes a dictionary of candidate site counts by family and predicts how
+    long searching them will take, from the cost of a candidate of that
+    category and, if a model registry is given, of each family's model."""
+
+    families = [{
+        "family": family, "candidates": candidates,
+        "time": round(candidates * candidate_cost(category, models.get(family)
+            if models is not None and candidates else None), 3)
+    } for family, candidates in counts.items()]
+    return {
+        "families": families,
+        "candidates": sum(family["candidates"] for family in families),
+        "time": round(sum(family["time"] for family in families), 3)
+    }
+
+
+def estimate_sequence_search(sequence, families=None, models=None):
+    """Estimates the size and duration of a sequence search, before any of
+    it is done. If a model registry is given, candidates are counted as they
+    will be once each family's gap bounds are applied, and costed with each
+    family's model - the models are only loaded for families with some
+    possible sites."""
+
+    counts = {}
+    for family in [f.split("_")[0] for f in get_sequence_families()]:
+        if family in (families or []) or not families:
+            counts[family] = count_sequence_family_sites(sequence, family)
+            if models is not None and counts[family]:
+                counts[family] = count_sequence_family_sites(
+                    sequence, family,
+                    getattr(models.get(family), "gap_bounds_", None)
+                )
+    return estimate_search("sequence", counts, models)
+
+
+def estimate_sequences_search(sequences, families=None, models=None,
+                              sample=SEQUENCES_ESTIMATE_SAMPLE):
+    """Estimates how many seconds searching an iterable of sequences will
+    take, in one pass and quickly enough for a whole proteome. The candidates
+    of every sequence are counted from its residue counts alone, and an evenly
+    spaced sample of between sample and twice sample sequences is estimated in
+    full, so that each family's total can be scaled by how many of the
+    sample's candidates are left once gap bounds are applied."""
+
+    subfamilies = {family.split("_")[0]: split_family(
+        family.split("_")[0].lower()
+    ) for family in get_sequence_families()
+        if family.split("_")[0] in (families or []) or not families}
+    codes = set(code for parts in subfamilies.values() for code, _ in parts)
+    totals, sampled, step = dict.fromkeys(subfamilies, 0), [], 1
+    for index, sequence in enumerate(sequences):
+        sequence = sequence.lower()
+        counts = {code: sequence.count(code) for code in codes}
+        candidates = {family: prod(comb(counts[code], count)
+            for code, count in parts) for family, parts in subfamilies.items()}
+        for family in totals: totals[family] += candidates[family]
+        if index % step == 0:
+            sampled.append((sequence, candidates))
+            if len(sampled) == 2 * sample:
+                sampled, step = sampled[::2], step * 2
+    pruned = dict.fromkeys(subfamilies, 0)
+    for sequence, _ in sampled:
+        for family in estimate_sequence_search(
+            sequence, families, models
+        )["families"]:
+            pruned[family["family"]] += family["candidates"]
+    counts = {}
+    for family, total in totals.items():
+        unpruned = sum(candidates[family] for _, candidates in sampled)
+        counts[family] = round(total * pruned[family] / unpruned)\
+            if unpruned else total
+    return estimate_search("sequence", counts, models)["time"]
+
+
+def estimate_structure_search(structure, families=None, models=None):
+    """Estimates the size and duration of a structure search from the arrays
+    of the structure, before any of it is done. Candidates are counted as they
+    will be once sites too spread out to bind zinc are pruned, and costed
+    with each family's model if a model registry is given."""
+
+    return estimate_search("structure", {
+        family: estimate_structure_family_sites(
+            structure["residues"], family, STRUCTURE_DISTANCE_CUTOFF
         )
-    potential_sites = [[
-        index for subsite in site for index in subsite
-    ] for site in product(*subfamily_combinations)]
-    return ["".join(
-        char.upper() if i in site else char for i, char in enumerate(sequence)
-    ) for site in potential_sites]
+        for family in [f.split("_")[0] for f in get_structure_families()]
+        if family in (families or []) or not families
+    }, models)
+
+
+def family_size(family):
+    """Gets the number of residues in a family's binding sites."""
+
+    return sum(subfamily[1] for subfamily in split_family(family))
+
+
+def site_to_sequence(sequence, site):
+    """Takes a sequence and the residue indices of a site within it, and
+    returns the sequence with the site's residues in upper case and everything
+    else in lower case."""
+
+    characters = list(sequence.lower())
+    for index in site: characters[index] = characters[index].upper()
+    return "".join(characters)
 
 
 def get_model_for_job(filename):
@@ -114,6 +643,139 @@ def get_model_for_job(filename):
     return model
 
 
+def get_structure_for_job(filename):
+    """Gets the arrays of a structure from a local structure file, along with
+    whether they came from the structure cache. Structures are cached on disk
+    under the SHA-256 hash of the file's contents, so a file that has been
+    seen before doesn't need parsing again."""
+
+    path = f"server{os.path.sep}jobs{os.path.sep}{filename}"
+    location = os.path.join(STRUCTURE_CACHE_DIRECTORY, f"{file_hash(path)}.npz")
+    try:
+        structure = load_structure_arrays(location)
+        os.utime(location)
+        return structure, True
+    except FileNotFoundError:
+        structure = structure_arrays(atomium.open(path).model)
+        save_structure_arrays(structure, location)
+        prune_structure_cache()
+        return structure, False
+
+
+def get_structure_residues(filename):
+    """Gets the one letter code and CA location of every chain residue in the
+    first model of a local structure file - all that estimating a search of it
+    needs - without parsing the whole structure. PDB and mmCIF files are read
+    in one pass over their CA records, and other formats are parsed with
+    atomium. Nothing is cached, so that a job's structure is only ever parsed
+    (and cached) by the job itself."""
+
+    path = f"server{os.path.sep}jobs{os.path.sep}{filename}"
+    if path.endswith(".pdb"):
+        rows = pdb_ca_rows(path)
+    elif path.endswith(".cif"):
+        rows = mmcif_ca_rows(path)
+    else:
+        residues = [res for chain in atomium.open(path).model.chains()
+            for res in chain.residues()]
+        rows = [(res.name, *(res.atom(name="CA").location
+            if res.atom(name="CA") else [np.nan] * 3)) for res in residues]
+    return {"residues": {
+        "codes": np.array([CODES.get(row[0], "X") for row in rows], dtype=str),
+        "ca": np.array([row[1:] for row in rows], dtype=float).reshape(-1, 3)
+    }}
+
+
+def pdb_ca_rows(path):
+    """Reads the residue name and CA coordinates of each residue in the first
+    model of a PDB file, taking the first location of any alternate ones."""
+
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("ENDMDL"): break
+            if line.startswith("ATOM") and line[12:16].strip() == "CA"\
+                and line[16] in " A":
+                rows.append((
+                    line[17:20].strip(), line[30:38], line[38:46], line[46:54]
+                ))
+    return rows
+
+
+def mmcif_ca_rows(path):
+    """Reads the residue name and CA coordinates of each residue in the first
+    model of an mmCIF file, from the rows of its atom_site loop."""
+
+    rows, columns, model = [], [], None
+    with open(path) as f:
+        for line in f:
+            if line.startswith("_atom_site."):
+                columns.append(line.split()[0][11:])
+                continue
+            if not columns: continue
+            if line.startswith(("#", "loop_", "_", "data_")): break
+            values = line.split()
+            if len(values) != len(columns): continue
+            row = dict(zip(columns, values))
+            if model is None: model = row.get("pdbx_PDB_model_num")
+            if row.get("pdbx_PDB_model_num") != model: break
+            if row.get("group_PDB") == "ATOM" and row.get("label_atom_id") == "CA"\
+                and row.get("label_alt_id", ".") in ".?A":
+                rows.append((row["label_comp_id"], row["Cartn_x"],
+                    row["Cartn_y"], row["Cartn_z"]))
+    return rows
+
+
+def file_hash(path):
+    """Gets the SHA-256 hash of a file's contents, reading it a block at a
+    time."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_structure_arrays(structure, location):
+    """Saves the arrays of a structure to an .npz file. The file is written
+    under a temporary name first, so that a partly written file is never
+    read."""
+
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    with open(f"{location}.tmp", "wb") as f:
+        np.savez(f, **{f"{group}.{key}": value
+            for group, values in structure.items() for key, value in values.items()})
+    os.replace(f"{location}.tmp", location)
+
+
+def load_structure_arrays(location):
+    """Loads the arrays of a structure saved by save_structure_arrays."""
+
+    structure = {}
+    with np.load(location) as arrays:
+        for name in arrays.files:
+            group, key = name.split(".", 1)
+            structure.setdefault(group, {})[key] = arrays[name]
+    return structure
+
+
+def prune_structure_cache(limit=STRUCTURE_CACHE_SIZE):
+    """Deletes the least recently used structures from the structure cache
+    until it takes up no more than the given number of bytes."""
+
+    files = [entry for entry in os.scandir(STRUCTURE_CACHE_DIRECTORY)
+        if entry.name.endswith(".npz")]
+    files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    total = 0
+    for entry in files:
+        total += entry.stat().st_size
+        if total > limit:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError: pass
+
+
 def get_structure_families():
     """Get the families for which there are structure models."""
 
@@ -123,23 +785,135 @@ def get_structure_families():
     return sorted(set([model.split("-")[0] for model in models]))
 
 
-def model_to_family_inputs(model, family):
+def model_to_family_inputs(model, family, cache=None, cutoff=None):
     """Takes a model and returns a list of potential binding sites for a
-    given family."""
+    given family. The residues of each type are taken from the job cache if
+    one is given.
+
+    If a cutoff is given, only sites whose residues all have CA atoms within
+    that many Angstroms of each other are returned - the rest are never
+    generated. Sites come out in the same order either way."""
 
     family = family.lower()
     subfamilies = split_family(family)
-    subfamily_combinations = []
-    for subfamily in subfamilies:
-        residues = model.residues(code=subfamily[0].upper())
-        subfamily_combinations.append(
-            list(combinations(residues, subfamily[1]))
-        )
-    potential_sites = [[
-        residue for subsite in site for residue in subsite
-    ] for site in product(*subfamily_combinations)]
-    
-    return potential_sites
+    if cache is None: cache = JobCache()
+    residues = [cache.get(("residues", code.upper()), lambda: list(
+        model.residues(code=code.upper())
+    )) for code, _ in subfamilies]
+    pool = list({id(res): res for res in chain(*residues)}.values())
+    pool_indices = {id(res): i for i, res in enumerate(pool)}
+    groups = [[pool_indices[id(res)] for res in r] for r in residues]
+    neighbours = None if cutoff is None else location_neighbours(np.array([
+        res.atom(name="CA").location if res.atom(name="CA") else [np.nan] * 3
+        for res in pool
+    ], dtype=float).reshape(-1, 3), cutoff)
+    return [[pool[i] for i in site] for site in family_sites(
+        groups, [subfamily[1] for subfamily in subfamilies], neighbours
+    )]
+
+
+def structure_family_sites(table, family, cutoff=None, cache=None):
+    """Takes a residue table and returns an (n, k) array of the potential
+    binding sites for a given family, as indices of residues in the table. If
+    a cutoff is given, only sites whose residues all have CA atoms within that
+    many Angstroms of each other are returned, and the neighbours of each
+    residue are taken from the job cache if one is given."""
+
+    subfamilies = split_family(family.lower())
+    if cache is None: cache = JobCache()
+    groups = [np.nonzero(table["codes"] == code.upper())[0].tolist()
+        for code, _ in subfamilies]
+    neighbours = None if cutoff is None else cache.get(
+        ("neighbours", cutoff), lambda: location_neighbours(table["ca"], cutoff)
+    )
+    sizes = [subfamily[1] for subfamily in subfamilies]
+    sites = family_sites(groups, sizes, neighbours)
+    return np.array(sites, dtype=int).reshape(len(sites), sum(sizes))
+
+
+def count_structure_family_sites(table, family):
+    """Works out how many potential binding sites of a given family there are
+    in a residue table, before any are pruned."""
+
+    return prod(comb(int((table["codes"] == code.upper()).sum()), size)
+        for code, size in split_family(family.lower()))
+
+
+def estimate_structure_family_sites(table, family, cutoff):
+    """Estimates how many potential binding sites of a given family there are
+    in a residue table once sites whose residues' CA atoms aren't all within
+    the cutoff of each other are pruned. A site is counted from each of its
+    residues, as the sites that residue could make with the residues around
+    it, so sites whose residues are all near each other are counted exactly
+    and others are overestimated."""
+
+    subfamilies = split_family(family.lower())
+    located = ~np.isnan(table["ca"]).any(axis=1)
+    members = [(table["codes"] == code.upper()) & located for code, _ in subfamilies]
+    nearby = [cKDTree(table["ca"][member]).query_ball_point(
+        table["ca"][located], cutoff, return_length=True
+    ) - member[located] if member.any() else np.zeros(located.sum())
+        for member in members]
+    total = 0
+    for anchor, (_, size) in enumerate(subfamilies):
+        counts = np.ones(located.sum())
+        for group, (_, group_size) in enumerate(subfamilies):
+            counts *= comb_array(nearby[group], group_size - (group == anchor))
+        total += counts[members[anchor][located]].sum()
+    return int(round(total / sum(size for _, size in subfamilies)))
+
+
+def comb_array(n, k):
+    """Works out n choose k for an array of n."""
+
+    n = np.asarray(n, dtype=float)
+    result = np.ones(len(n))
+    for i in range(k): result *= np.maximum(n - i, 0) / (i + 1)
+    return result
+
+
+def family_sites(groups, sizes, neighbours=None):
+    """Takes lists of residue indices, one for each subfamily, and the number
+    of residues needed from each, and returns every site that can be made from
+    them as a list of indices - the same as taking the product of each
+    subfamily's combinations. If the neighbours of each residue are given,
+    sites are only extended with residues that neighbour every residue chosen
+    so far, so sites with residues that aren't all neighbours are never
+    generated."""
+
+    if neighbours is None:
+        return [[i for subsite in site for i in subsite] for site in product(*[
+            combinations(group, size) for group, size in zip(groups, sizes)
+        ])]
+    slots = [i for i, size in enumerate(sizes) for _ in range(size)]
+    sites = []
+    def extend(site, positions):
+        if len(site) == len(slots):
+            sites.append(site)
+            return
+        slot = slots[len(site)]
+        start = positions[-1] + 1 if site and slots[len(site) - 1] == slot else 0
+        for position in range(start, len(groups[slot])):
+            index = groups[slot][position]
+            if all(index in neighbours[i] for i in site):
+                extend(site + [index], positions + [position])
+    extend([], [])
+    return sites
+
+
+def location_neighbours(locations, cutoff):
+    """Takes an (n, 3) array of locations and returns, for each one, the set
+    of indices of the other locations within the cutoff distance of it, found
+    with a KD-tree. Locations which are NaN have no neighbours."""
+
+    located = np.nonzero(~np.isnan(locations).any(axis=1))[0].tolist()
+    neighbours = [set() for _ in range(len(locations))]
+    if len(located) > 1:
+        tree = cKDTree(locations[located])
+        for i, j in tree.query_pairs(cutoff):
+            neighbours[located[i]].add(located[j])
+            neighbours[located[j]].add(located[i])
+    return neighbours
 
 
 def get_structure_half_families():
@@ -5,9 +5,14 @@ import json
 from datetime import datetime
 from subprocess import Popen
 import requests
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.http import HttpResponse
 from django.conf import settings
+from django.views.decorators.http import condition
+from graphene_django.views import HttpError
+from graphene_file_upload.django import FileUploadGraphQLView
 from .utilities import *
+from .store import FINISHED_STATUSES
 
 PATHS = {
  "/structure?code=XXXX": "Find zinc binding sites in PDB structure",
@@ -16,6 +21,8 @@ PATHS = {
  "/sequence/{ID}/": "The results of a sequence job"
 }
 
+EVENT_FIELDS = ["status", "site_count", "rejected_count"]
+
 def root(request):
     return JsonResponse({
      "/": "root", **PATHS
@@ -57,7 +64,92 @@ def predict_sequence(request):
     }, json_dumps_params={"indent": 2})
 
 
+def job_etag(request, id):
+    """Gets the ETag of a job - its revision - or None if it has none."""
+
+    revision = job_revision(id)
+    return None if revision is None else str(revision)
+
+
+@condition(etag_func=job_etag)
 def job(request, id):
-    with open(f"server/jobs/{id}/job.json") as f:
-        data = json.load(f)
-    return JsonResponse(data, json_dumps_params={"indent": 2})
\ No newline at end of file
+    """Returns a job as JSON, with its revision as the ETag. A request whose
+    If-None-Match has the job's current revision gets a 304 response, without
+    the job being read."""
+
+    data = load_job(id, track=False)
+    if data is None: raise Http404
+    response = JsonResponse(data, json_dumps_params={"indent": 2})
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def job_events(request, id):
+    """Streams the progress of a job as Server-Sent Events - a status event
+    whenever the job's fields change, a sites event whenever new sites are
+    found, and a done event once it has finished. The changes are pushed by
+    the worker pool, so nothing is read from the job store between events."""
+
+    snapshot = load_job(id, EVENT_FIELDS, track=False)
+    if snapshot is None: raise Http404
+    response = StreamingHttpResponse(
+        stream_job_events(id, snapshot), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def stream_job_events(id, snapshot):
+    """Yields the events of a job, starting with its current state. Changes
+    are taken from the worker pool, or if it isn't running (or stops), the
+    job's status is checked every second instead."""
+
+    status = snapshot["status"]
+    connection = watch_job(id) if status not in FINISHED_STATUSES else None
+    try:
+        # Anything saved before the pool was watching is in the snapshot
+        if connection: snapshot = load_job(id, EVENT_FIELDS, track=False) or snapshot
+        yield sse_event("status", snapshot)
+        status = snapshot["status"]
+        while status not in FINISHED_STATUSES:
+            if connection:
+                if not connection.poll(15):
+                    yield ": keepalive\n\n"
+                    continue
+                try:
+                    message = json.loads(connection.recv_bytes())
+                except (EOFError, OSError):
+                    connection = connection.close()
+                    continue
+            else:
+                time.sleep(1)
+                fields = load_job(id, ["status"], track=False) or {"status": "error"}
+                message = {"fields": fields if fields["status"] != status else {}}
+            if message.get("sites"): yield sse_event("sites", message["sites"])
+            fields = {k: v for k, v in message["fields"].items() if k in EVENT_FIELDS}
+            if fields: yield sse_event("status", fields)
+            status = fields.get("status", status)
+        yield sse_event("done", {"status": status})
+    finally:
+        if connection: connection.close()
+
+
+def sse_event(name, data):
+    """Formats a single Server-Sent Event."""
+
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+
+class UploadGraphQLView(FileUploadGraphQLView):
+    """The GraphQL view, which rejects requests whose file upload was stopped
+    for being too big with a 413 response - the stopped file isn't in the
+    request's files for the query to use."""
+
+    def parse_body(self, request):
+        try:
+            return FileUploadGraphQLView.parse_body(self, request)
+        except KeyError:
+            if not hasattr(request, "upload_error"): raise
+            raise HttpError(HttpResponse(status=413), request.upload_error)
@@ -0,0 +1,460 @@
+#! /usr/bin/env python3
+
+"""This script runs a pool of long-lived worker processes which carry out
+search jobs. Every model is loaded once when the pool starts, and is shared by
+the workers, which then take jobs from a queue - so jobs don't have to wait for
+Python to start and for models to load. The GraphQL API sends jobs to the pool
+over a local socket, and only starts a process per job if the pool isn't
+running.
+
+    python -m server.workers --workers=4
+
+Sending the pool SIGHUP restarts it gracefully - a fresh set of workers (with
+freshly loaded models) starts taking jobs, and the old ones exit once they have
+finished the job they are on. SIGTERM or Ctrl-C stops accepting jobs, and
+stops the pool once the queue has been emptied and the running jobs are done.
+
+No more jobs run at once than there are workers, and each model predicts on a
+single thread. Waiting jobs are run in order of priority, by how long they are
+estimated to take, and within a priority each client's jobs take turns with
+every other client's - so quick searches don't wait behind big ones, and one
+client can't hold up everyone else by sending many. Jobs estimated to take
+longer than SEARCH_THROTTLE_TIME are never run by more than JOB_HEAVY_WORKERS
+workers at once. A waiting job's status gives its place in the queue.
+
+The pool also deletes old jobs every JOB_REAP_INTERVAL seconds - see
+server/reaper.py.
+
+Every change the workers make to a job is passed on, as it is saved, to
+anything watching that job over a second local socket - this is how the API
+streams a job's progress to clients without polling."""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import traceback
+import multiprocessing
+from queue import Queue, Empty
+from collections import OrderedDict, deque
+from threading import Thread, Condition, Lock
+from multiprocessing.connection import Listener, wait
+from .utilities import ModelRegistry, get_job_store
+from .store import FINISHED_STATUSES
+from .settings import JOB_WORKERS, JOB_QUEUE_ADDRESS, JOB_PRIORITY_TIMES
+from .settings import JOB_EVENTS_ADDRESS
+from .settings import SEARCH_THROTTLE_TIME, JOB_HEAVY_WORKERS, JOB_REAP_INTERVAL
+from .reaper import reap
+from . import sequence_job, sequences_job, structure_job
+
+WATCHER_BACKLOG = 64
+JOBS = {
+    "sequence": (sequence_job.run, "sequence"),
+    "sequences": (sequences_job.run, "sequence"),
+    "structure": (structure_job.run, "structure")
+}
+
+def main():
+    count = JOB_WORKERS
+    for arg in sys.argv[1:]:
+        if arg.startswith("--workers="): count = int(arg[10:])
+
+    # Listen for jobs on the local socket, and hand them out as workers free up
+    if os.path.exists(JOB_QUEUE_ADDRESS): os.remove(JOB_QUEUE_ADDRESS)
+    listener = Listener(JOB_QUEUE_ADDRESS, family="AF_UNIX")
+    queues = {name: multiprocessing.Queue() for name in ("tasks", "events", "changes")}
+    scheduler = Scheduler(JOB_HEAVY_WORKERS)
+    Thread(target=accept_jobs, args=(listener, scheduler), daemon=True).start()
+
+    # Pass changes to jobs on to anyone watching them
+    if os.path.exists(JOB_EVENTS_ADDRESS): os.remove(JOB_EVENTS_ADDRESS)
+    hub = EventHub(Listener(JOB_EVENTS_ADDRESS, family="AF_UNIX"))
+    get_job_store().listeners.append(hub.publish)
+    Thread(target=dispatch_jobs, args=(scheduler, queues), daemon=True).start()
+    Thread(target=publish_changes, args=(queues, hub), daemon=True).start()
+    Thread(target=reap_jobs, daemon=True).start()
+
+    # Restart or stop on signals
+    signals = []
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+    # Keep the pool topped up until told to stop
+    models = load_models()
+    retired, workers = start_workers(queues, count, models)
+    retiring = []
+    print(f"Started {count} workers, listening on {JOB_QUEUE_ADDRESS}")
+    while True:
+        if signal.SIGHUP in signals:
+            signals.remove(signal.SIGHUP)
+            retired.set()
+            retiring += workers
+            models = load_models()
+            scheduler.reset()
+            retired, workers = start_workers(queues, count, models)
+            print(f"Restarted {count} workers")
+        elif signals:
+            break
+        for worker in workers + retiring:
+            if not worker.is_alive() and worker.exitcode: scheduler.lost(worker.name)
+        workers = [worker if worker.is_alive() else start_worker(
+            queues, retired, models
+        ) for worker in workers]
+        retiring = [worker for worker in retiring if worker.is_alive()]
+        time.sleep(1)
+
+    # Finish the queued and running jobs
+    listener.close()
+    hub.listener.close()
+    print("Finishing queued jobs...")
+    while scheduler.waiting() or not queues["tasks"].empty(): time.sleep(1)
+    retired.set()
+    for worker in workers + retiring: worker.join()
+
+
+class Scheduler:
+    """Keeps the jobs waiting to be run, and decides which to run next. Each
+    priority has a queue of jobs per client, and the clients are taken in
+    turn. Workers report when they start a job and when they are ready for
+    another, and the scheduler counts how many are free, and keeps which job
+    each is on and how many heavy jobs are running. Workers are known by their
+    process names, which unlike their PIDs are never reused."""
+
+    def __init__(self, heavy_limit):
+        self.priorities = [OrderedDict() for _ in range(len(JOB_PRIORITY_TIMES) + 1)]
+        self.heavy_limit, self.heavy = heavy_limit, set()
+        self.free, self.positions, self.changed = 0, {}, False
+        self.running, self.dead = {}, set()
+        self.condition = Condition()
+
+
+    def add(self, message):
+        """Adds a job to the queue of its client, in its priority."""
+
+        with self.condition:
+            estimate = message.get("estimate", 0)
+            priority = sum(estimate > limit for limit in JOB_PRIORITY_TIMES)
+            clients = self.priorities[priority]
+            clients.setdefault(message.get("client"), deque()).append(message)
+            self.changed = True
+            self.condition.notify()
+
+
+    def start(self, worker, job_id):
+        """Records that a worker has started a job. If the worker has already
+        been found dead, the job is given up straight away."""
+
+        with self.condition:
+            self.running[worker] = job_id
+            if worker in self.dead: self.lost(worker)
+
+
+    def ready(self, worker=None, job_id=None, free=True):
+        """Records that a worker has finished a job (if it was on one), and
+        whether it is free for another."""
+
+        with self.condition:
+            self.running.pop(worker, None)
+            self.heavy.discard(job_id)
+            self.free += free
+            self.changed = True
+            self.condition.notify()
+
+
+    def lost(self, worker):
+        """Records that a worker has died. The job it was on, if any, is
+        marked as failed, and its heavy slot is freed."""
+
+        with self.condition:
+            self.dead.add(worker)
+            job_id = self.running.pop(worker, None)
+            if job_id is None: return
+            self.heavy.discard(job_id)
+            self.changed = True
+            self.condition.notify()
+        try:
+            get_job_store().update(job_id, {"status": "error"})
+        except Exception: traceback.print_exc()
+
+
+    def reset(self):
+        """Forgets which workers are free, when a new generation of workers is
+        about to start and say so themselves. Heavy jobs are still counted, as
+        the retiring workers finish them and say so before they go."""
+
+        with self.condition: self.free = 0
+
+
+    def next(self):
+        """Takes the job which should run next off the queue, or returns None
+        if no worker is free or there's nothing that can be run yet. Within a
+        priority, the client whose job it was goes to the back."""
+
+        if self.free < 1: return None
+        for clients in self.priorities:
+            for client, messages in clients.items():
+                if is_heavy(messages[0]) and len(self.heavy) >= self.heavy_limit:
+                    continue
+                message = messages.popleft()
+                if messages: clients.move_to_end(client)
+                else: del clients[client]
+                if is_heavy(message): self.heavy.add(message["arguments"]["job_id"])
+                self.free -= 1
+                return message
+
+
+    def waiting(self):
+        """Lists the waiting jobs in the order they would run in, if every one
+        were run as soon as possible."""
+
+        with self.condition:
+            order = []
+            for clients in self.priorities:
+                queues = [list(messages) for messages in clients.values()]
+                for turn in range(max(map(len, queues), default=0)):
+                    order += [messages[turn] for messages in queues if turn < len(messages)]
+            return order
+
+
+    def update_positions(self):
+        """Records each waiting job's place in the queue as its status, for
+        any job whose place has changed."""
+
+        positions = {message["arguments"]["job_id"]: position
+            for position, message in enumerate(self.waiting(), start=1)}
+        for job_id, position in positions.items():
+            if self.positions.get(job_id) != position:
+                get_job_store().update(job_id, {
+                    "status": f"Queued - position {position}"
+                })
+        self.positions = positions
+
+
+
+class EventHub:
+    """Keeps the connections of everything watching a job - each sends the ID
+    of the job it wants to watch when it connects, and is answered once it is
+    watching - and passes on to each of them the changes to that job. Once the
+    job has finished, its watchers are disconnected.
+
+    Publishing never waits on a watcher. Each watcher has a queue of messages
+    and a thread of its own which sends them, and a watcher which falls more
+    than WATCHER_BACKLOG messages behind is hung up on. Watchers never send
+    anything after the job ID, so one with something to read has gone away,
+    and is hung up on too."""
+
+    def __init__(self, listener):
+        self.listener, self.watchers, self.lock = listener, {}, Lock()
+        Thread(target=self.accept, daemon=True).start()
+        Thread(target=self.sweep, daemon=True).start()
+
+
+    def accept(self):
+        """Takes new watchers from the listener."""
+
+        while True:
+            try:
+                connection = self.listener.accept()
+                job_id = connection.recv_bytes().decode()
+                outbox = Queue()
+                outbox.put(b"{}")
+                with self.lock:
+                    self.watchers.setdefault(job_id, {})[connection] = outbox
+                Thread(target=self.send, args=(
+                    job_id, connection, outbox
+                ), daemon=True).start()
+            except OSError: return
+            except Exception: traceback.print_exc()
+
+
+    def send(self, job_id, connection, outbox):
+        """Sends a watcher the messages queued for it, until it is dropped, and
+        then closes its connection."""
+
+        try:
+            for message in iter(outbox.get, None): connection.send_bytes(message)
+        except OSError: pass
+        with self.lock: self.drop(job_id, connection)
+        connection.close()
+
+
+    def sweep(self, interval=1):
+        """Hangs up on the watchers which have disconnected - whether or not
+        their job is still changing - as soon as they do."""
+
+        while True:
+            with self.lock:
+                connections = {connection: job_id
+                    for job_id, watchers in self.watchers.items()
+                    for connection in watchers}
+            if not connections:
+                time.sleep(interval)
+                continue
+            try:
+                closed = wait(list(connections), timeout=interval)
+            except (OSError, ValueError): continue
+            with self.lock:
+                for connection in closed:
+                    self.drop(connections[connection], connection, hang_up=True)
+
+
+    def publish(self, job_id, fields, sites):
+        """Queues a change to a job for everything watching it."""
+
+        with self.lock:
+            if job_id not in self.watchers: return
+            message = json.dumps({"fields": fields, "sites": sites}).encode()
+            finished = fields.get("status") in FINISHED_STATUSES
+            for connection, outbox in list(self.watchers[job_id].items()):
+                if outbox.qsize() >= WATCHER_BACKLOG:
+                    self.drop(job_id, connection, hang_up=True)
+                    continue
+                outbox.put(message)
+                if finished: self.drop(job_id, connection)
+
+
+    def drop(self, job_id, connection, hang_up=False):
+        """Stops a watcher watching its job. Its thread sends what is already
+        queued for it and closes its connection - unless it is hung up on,
+        in which case the connection is shut down straight away, even if the
+        thread is part way through sending. The lock must be held."""
+
+        outbox = self.watchers.get(job_id, {}).pop(connection, None)
+        if outbox is None: return
+        if not self.watchers[job_id]: del self.watchers[job_id]
+        outbox.put(None)
+        if not hang_up: return
+        try:
+            with socket.fromfd(
+                connection.fileno(), socket.AF_UNIX, socket.SOCK_STREAM
+            ) as sock: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+
+def is_heavy(message):
+    """Checks if a job is estimated to take long enough to be throttled."""
+
+    return message.get("estimate", 0) > SEARCH_THROTTLE_TIME
+
+
+def accept_jobs(listener, scheduler):
+    """Takes jobs sent to the listener - one JSON message per connection - and
+    adds them to the scheduler."""
+
+    while True:
+        try:
+            with listener.accept() as connection:
+                scheduler.add(json.loads(connection.recv_bytes()))
+        except OSError: return
+        except Exception: traceback.print_exc()
+
+
+def dispatch_jobs(scheduler, queues):
+    """Hands the next job to the workers whenever one is free, and keeps the
+    places of waiting jobs up to date. Workers say when they start a job and
+    when they are ready for another through the events queue."""
+
+    def receive_events():
+        for event in iter(queues["events"].get, None):
+            if "started" in event: scheduler.start(event["worker"], event["started"])
+            else: scheduler.ready(**event)
+
+    Thread(target=receive_events, daemon=True).start()
+    while True:
+        with scheduler.condition:
+            while not scheduler.changed: scheduler.condition.wait()
+            scheduler.changed = False
+            messages = list(iter(scheduler.next, None))
+        try:
+            scheduler.update_positions()
+        except Exception: traceback.print_exc()
+        for message in messages: queues["tasks"].put(message)
+
+
+def publish_changes(queues, hub):
+    """Passes the changes the workers make to jobs, which they send through
+    the changes queue, on to the event hub."""
+
+    for change in iter(queues["changes"].get, None):
+        try:
+            hub.publish(**change)
+        except Exception: traceback.print_exc()
+
+
+def reap_jobs():
+    """Deletes expired jobs, and old jobs if they take up too much space,
+    every JOB_REAP_INTERVAL seconds."""
+
+    while True:
+        try:
+            deleted, freed = reap()
+            if deleted:
+                print(f"Deleted {deleted} old jobs ({round(freed / 1024 ** 2, 1)} MB)")
+        except Exception: traceback.print_exc()
+        time.sleep(JOB_REAP_INTERVAL)
+
+
+def start_workers(queues, count, models):
+    """Starts a generation of workers taking jobs from the task queue, and
+    returns the event which retires them along with the processes."""
+
+    retired = multiprocessing.Event()
+    return retired, [start_worker(queues, retired, models) for _ in range(count)]
+
+
+def start_worker(queues, retired, models):
+    """Starts a single worker process. Where processes are forked, the worker
+    shares the memory of the models already loaded, until it writes to it."""
+
+    worker = multiprocessing.Process(target=work, args=(queues, retired, models))
+    worker.start()
+    return worker
+
+
+def work(queues, retired, models):
+    """Carries out jobs from the task queue until retired, saying when it
+    starts each one and when it is ready for the next. Jobs which fail don't
+    stop the worker."""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    get_job_store().listeners[:] = [lambda job_id, fields, sites: queues[
+        "changes"
+    ].put({"job_id": job_id, "fields": fields, "sites": sites})]
+    worker = multiprocessing.current_process().name
+    queues["events"].put({"worker": worker})
+    while not retired.is_set():
+        try:
+            message = queues["tasks"].get(timeout=1)
+        except Empty: continue
+        job_id = message["arguments"]["job_id"]
+        queues["events"].put({"worker": worker, "started": job_id})
+        run, category = JOBS[message["job"]]
+        try:
+            run(message["arguments"], models=models[category])
+        except Exception: traceback.print_exc()
+        queues["events"].put({
+            "worker": worker, "job_id": job_id, "free": not retired.is_set()
+        })
+
+
+def load_models():
+    """Loads the models of every family, for both sequences and structures,
+    and reports how long each took to load and how big it is. Each model
+    predicts on a single thread, as the workers already share out the cores."""
+
+    models = {category: ModelRegistry(category).load_all()
+        for category in ("sequence", "structure")}
+    for category, registry in models.items():
+        for family, stats in registry.stats.items():
+            registry.get(family).n_jobs = 1
+            print(f"Loaded {category} {family} model in {stats['load_time']}s "
+                f"({round(stats['size'] / 1024 ** 2, 1)} MB)")
+    return models
+
+
+if __name__ == "__main__": main()